@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+# Imports ################################################################
+
+from __future__ import print_function
+
+import os, sys, json, random, argparse, tempfile, shutil, subprocess, resource, imp, time
+
+from datetime import datetime, timedelta
+
+
+# Functions ##############################################################
+
+def generate_logs(log_path, nb_players, nb_days, events_per_player, start_date,
+                  nb_files=10, legacy_percent=5, noise_percent=60, seed=0):
+    '''Writes Twisted-style logs of the webservice, rotated into nb_files files,
+    along with the email2id.json and name2id.json maps of the legacy player ids'''
+
+    rnd = random.Random(seed)
+    actions_names = ['state', 'state', 'state', 'poll', 'create', 'join', 'invitation',
+                     'pick', 'vote', 'voting', 'complete']
+    noise_lines = ['[-] Log opened.',
+                   '[HTTPChannel,%d,127.0.0.1] 127.0.0.1 - - "GET /static/css/all.css HTTP/1.1" 304 - "-" "Mozilla/5.0"',
+                   '[HTTPChannel,%d,127.0.0.1] 127.0.0.1 - - "GET /poll?modified=1320000000 HTTP/1.1" 200 12 "-" "Mozilla/5.0"',
+                   '[cardstories.service] game %d: state change']
+
+    email2id = {}
+    name2id = {}
+    events = []
+    for player_id in xrange(1, nb_players + 1):
+        if rnd.randint(1, 100) <= legacy_percent:
+            if rnd.randint(0, 1):
+                legacy_id = 'player%d@example.com' % player_id
+                email2id[legacy_id] = player_id
+            else:
+                legacy_id = 'player%d' % player_id
+                name2id[legacy_id] = [player_id, legacy_id]
+        else:
+            legacy_id = None
+
+        cur_second = rnd.randint(0, nb_days * 24 * 3600 - 1)
+        for i in xrange(events_per_player):
+            if cur_second >= nb_days * 24 * 3600:
+                break
+
+            parameters = ['action=%s' % rnd.choice(actions_names)]
+            if legacy_id and rnd.randint(0, 1):
+                parameters.append('player_id=%s' % legacy_id.replace('@', '%40'))
+            else:
+                parameters.append('%s_id=%d' % (rnd.choice(['owner', 'player']), player_id))
+            parameters.append('game_id=%d' % rnd.randint(1, nb_players))
+            events.append((cur_second, '&'.join(parameters)))
+
+            # Mostly short gaps within a session, sometimes coming back days later
+            cur_second += rnd.choice([2, 5, 10, 30, 60, 300, 3600, 20 * 3600, 3 * 24 * 3600])
+
+    events.sort()
+
+    lines = []
+    for second, query in events:
+        timestamp = (start_date + timedelta(seconds=second)).strftime('%Y-%m-%d %H:%M:%S')
+        while rnd.randint(1, 100) <= noise_percent:
+            lines.append('%s+0100 %s\n' % (timestamp, rnd.choice(noise_lines).replace('%d', str(rnd.randint(1, 99)))))
+        lines.append('%s+0100 [HTTPChannel,%d,127.0.0.1] 127.0.0.1 - - "GET /resource?%s HTTP/1.1" 200 42 "-" "Mozilla/5.0"\n' %
+                     (timestamp, rnd.randint(1, 99), query))
+
+    # Oldest lines in the highest numbers, newest ones in the live log
+    lines_per_file = len(lines) / nb_files + 1
+    for file_nb in xrange(nb_files):
+        suffix = '.%d' % (nb_files - 1 - file_nb) if file_nb < nb_files - 1 else ''
+        with open(log_path + suffix, 'w') as f:
+            f.writelines(lines[file_nb * lines_per_file:(file_nb + 1) * lines_per_file])
+
+    log_dir = os.path.dirname(log_path)
+    with open(os.path.join(log_dir, 'email2id.json'), 'w') as f:
+        json.dump(email2id, f)
+    with open(os.path.join(log_dir, 'name2id.json'), 'w') as f:
+        json.dump(name2id, f)
+
+    return len(lines)
+
+def write_settings(work_dir, log_path):
+    with open(os.path.join(work_dir, 'settings.py'), 'w') as f:
+        f.write('OWA_URL = None\n'
+                'OWA_API_KEY = None\n'
+                'OWA_SITE_ID = None\n'
+                'EMAIL2ID_JSON_PATH = %r\n'
+                'NAME2ID_JSON_PATH = %r\n'
+                'WS_LOG_PATH = %r\n'
+                'JSON_OUTPUT_PATH = %r\n' % (os.path.join(work_dir, 'email2id.json'),
+                                             os.path.join(work_dir, 'name2id.json'),
+                                             log_path,
+                                             os.path.join(work_dir, 'cardstories_stats.json')))
+
+def get_peak_memory():
+    '''Peak resident set size of the current process, in MB'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# Classes ################################################################
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.stages = []
+
+    def time(self, name, function, *args):
+        start_time = time.time()
+        start_cpu = sum(os.times()[:2])
+        result = function(*args)
+        self.stages.append({'name': name,
+                            'seconds': time.time() - start_time,
+                            'cpu_seconds': sum(os.times()[:2]) - start_cpu,
+                            'peak_memory': get_peak_memory()})
+        return result
+
+
+class Benchmark(object):
+    '''Times each stage of the stats pipeline on generated logs, in the current process'''
+
+    start_date = datetime(2011, 10, 10, 0, 0, 0)
+
+    def __init__(self, work_dir, nb_lines):
+        self.nb_lines = nb_lines
+
+        # Settings from the settings.py of the generated logs
+        sys.path.insert(0, work_dir)
+        stats_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser.py')
+        self.stats = imp.load_source('cardstories_stats', stats_path)
+        self.stats.load_settings()
+
+    def run(self):
+        stats = self.stats
+        timer = StageTimer()
+
+        action_set = stats.ActionSet(self.start_date)
+        actions = timer.time('parsing', lambda: list(action_set.iter_actions()))
+        action_set.end_date = max(action.date for action in actions)
+
+        reference_set = stats.ActionSet(self.start_date, reference_parser=True)
+        timer.time('reference parsing', lambda: list(reference_set.iter_actions()))
+        mismatches = list(stats.ActionSet(self.start_date).iter_parser_mismatches())
+
+        def process(consumer):
+            for action in actions:
+                consumer.record_action(action)
+            return consumer
+
+        cohort_set = timer.time('CohortSet', process, stats.CohortSet(action_set))
+        week_set = timer.time('WeeklyPlayerActivity', stats.WeeklyPlayerActivity, cohort_set)
+        concurrent_players = timer.time('ConcurrentPlayers', process, stats.ConcurrentPlayers(action_set))
+        funnel = timer.time('Funnel', process, stats.Funnel(action_set))
+        funnel.owa_data = {'rows': []}
+
+        def output():
+            data = {}
+            data['weekly_actives'] = stats.add_average_to_weekly_set(cohort_set.get_weekly_actives())
+            data['weekly_actives_percent'] = stats.add_average_to_weekly_set(cohort_set.get_weekly_actives_percent())
+            data['active_players_per_week'] = week_set.get_active_players_per_week()
+            data['concurrent_players'] = concurrent_players.get_concurrent_players_trimmed()
+            data['enough_players_percent'] = concurrent_players.get_time_percent_with_enough_players()
+            data['funnel'] = stats.add_average_to_weekly_set(funnel.get_weekly_steps_percent())
+            with open(stats.JSON_OUTPUT_PATH, 'w+') as f:
+                json.dump(data, f)
+
+        timer.time('output', output)
+
+        # Whole pipeline, in a single pass over the logs
+        action_set = stats.ActionSet(self.start_date)
+        consumers = [stats.ConcurrentPlayers(action_set), stats.CohortSet(action_set), stats.Funnel(action_set)]
+        timer.time('single pass', action_set.process_actions, consumers)
+
+        return {'lines': self.nb_lines,
+                'actions': len(actions),
+                'parser_mismatches': len(mismatches),
+                'stages': timer.stages}
+
+
+# Main ###################################################################
+
+def run_size(nb_players, nb_days, events_per_player):
+    '''Runs the benchmark of one data size in a separate process, to measure its own peak memory'''
+    work_dir = tempfile.mkdtemp(prefix='cardstories_bench_')
+    try:
+        log_path = os.path.join(work_dir, 'cardstories.org_twisted.log')
+        nb_lines = generate_logs(log_path, nb_players, nb_days, events_per_player, Benchmark.start_date)
+        write_settings(work_dir, log_path)
+
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--worker',
+                                          '--work-dir', work_dir, '--lines', str(nb_lines)])
+    finally:
+        shutil.rmtree(work_dir)
+    return json.loads(output)
+
+def print_results(nb_players, nb_days, events_per_player, results):
+    print('%d players, %d days, %d events per player: %d lines, %d actions' %
+          (nb_players, nb_days, events_per_player, results['lines'], results['actions']))
+    print('    %-22s %9s %9s %12s %10s' % ('stage', 'seconds', 'cpu', 'lines/sec', 'peak MB'))
+    for stage in results['stages']:
+        if stage['name'] in ('parsing', 'reference parsing', 'single pass'):
+            lines_per_second = '%d' % (results['lines'] / max(stage['seconds'], 1e-6))
+        else:
+            lines_per_second = '-'
+        print('    %-22s %9.3f %9.3f %12s %10.1f' % (stage['name'], stage['seconds'], stage['cpu_seconds'],
+                                                   lines_per_second, stage['peak_memory']))
+    if results['parser_mismatches']:
+        print('    %d lines parsed differently by the reference parser, see parser.py --check-parser' %
+              results['parser_mismatches'])
+    print()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmarks the stats pipeline on generated logs')
+    arg_parser.add_argument('--players', default='100,1000,10000',
+                            help='comma-separated numbers of players, one run per number (default: 100,1000,10000)')
+    arg_parser.add_argument('--days', type=int, default=60, help='days covered by the logs (default: 60)')
+    arg_parser.add_argument('--events', type=int, default=50, help='webservice calls per player (default: 50)')
+    arg_parser.add_argument('--json', help='also write the results to this file')
+    arg_parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    arg_parser.add_argument('--lines', type=int, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.worker:
+        benchmark = Benchmark(args.work_dir, args.lines)
+        print(json.dumps(benchmark.run()))
+        return
+
+    all_results = []
+    for nb_players in [int(x) for x in args.players.split(',')]:
+        results = run_size(nb_players, args.days, args.events)
+        print_results(nb_players, args.days, args.events, results)
+        all_results.append({'players': nb_players, 'days': args.days, 'events': args.events, 'results': results})
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
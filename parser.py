@@ -2,16 +2,79 @@
 
 # Imports ################################################################
 
-import re, urlparse, urllib, requests, json, math, os
+import re, urlparse, urllib, requests, json, math, os, hashlib, cPickle, struct, mmap, calendar, array, \
+       multiprocessing, argparse, gzip, bz2, threading, Queue, logging, resource, time, cProfile, signal, \
+       importlib, bisect, sys, sqlite3, tempfile
+
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from datetime import datetime, timedelta
 from time import mktime
 
-from settings import *
+# Imported by the first datetime.strptime() call otherwise, which fails when it is made
+# by the OWA thread while another thread holds the import lock, e.g. as the pool forks
+import _strptime
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None # Only needed to read .xz logs
+
+# Optional settings, which can be overridden in settings.py - see load_settings()
+CHECKPOINT_PATH = None # Set to a file path to only process new log lines on each run
+ACTION_CACHE_PATH = None # Set to a directory to cache the actions parsed from rotated logs
+LEGACY_IDS_PATH = None # Set to a file path to look up the legacy player ids in a database, rather than in memory
+LOG_INDEX_PATH = None # Set to a file path to index the dates of the log files, to read them from a date quickly
+CONCURRENCY_WINDOW_DAYS = 30 # Concurrent players are shown for the last days of logs
+CONCURRENCY_RESOLUTION = 60 # Size of the concurrent players buckets, in seconds - must divide an hour
+ENOUGH_PLAYERS = 3 # Minimum number of concurrent players for a game to be possible
+OWA_CACHE_PATH = None # Set to a file path to only fetch the missing and recent days from OWA
+OWA_TIMEOUT = 60 # Seconds to wait for OWA before falling back to the cached days
+OWA_REFRESH_DAYS = 2 # Recent days which are fetched again, as their numbers can still change
+# Dataset name => (downsampling method, maximum number of points of each of its series), see
+# downsample_series() - 'min_max' keeps the peaks, 'lttb' the overall shape of the curve. Applies
+# to JSON_OUTPUT_PATH and to the overviews of SHARDED_OUTPUT_PATH, whose days keep the full resolution.
+DOWNSAMPLING = {}
+SHARDED_OUTPUT_PATH = None # Set to a directory to also write each dataset in its own files, for the dashboard
+# Downsampling of the overviews of the time series of SHARDED_OUTPUT_PATH, which the dashboard shows
+# for their whole range, for the datasets which aren't in DOWNSAMPLING
+OVERVIEW_DOWNSAMPLING = ('min_max', 2000)
+FOLLOW_INTERVAL = 60 # Seconds between two updates of the output with --follow
+FOLLOW_CHECKPOINT_INTERVAL = 3600 # Seconds between two saves of the checkpoint with --follow
+FOLLOW_OWA_INTERVAL = 3600 # Seconds between two fetches of the OWA data with --follow
+# Set to a number of MB to bound the memory used by the state of the players in each consumer,
+# and in each worker process with --jobs, the players who weren't seen recently being spilled
+# to a database in PLAYERS_SPILL_PATH
+PLAYERS_MEMORY_BUDGET = None
+PLAYERS_SPILL_PATH = None # Directory of the spilled players and of the results of the workers, the system temporary directory by default
+ROLLUP_PATH = None # Set to a file path to save the active days of each player, to compute the cohorts again with --from-rollup
+# Set to a relative error, eg 0.02, to count the distinct players of the cohorts and of the
+# concurrency buckets with HyperLogLog sketches in bounded memory, rather than exactly with sets.
+# The cohorts still keep the cohort of each player, so their memory still grows with the number
+# of players. With PLAYERS_MEMORY_BUDGET, they are counted exactly, from the spilled players.
+APPROXIMATE_COUNTS_ERROR = None
+
+logger = logging.getLogger('cardstories.stats')
+
+# Set by ActionSet.process_actions_parallel() for its worker processes
+parallel_context = None
 
 
 # Functions ##############################################################
 
+def load_settings(settings_module='settings'):
+    '''Reads the settings like "from settings import *" would. Only done once the
+    stats are about to be computed, so that this module can be imported as a library.'''
+
+    module = importlib.import_module(settings_module)
+    names = getattr(module, '__all__', [name for name in dir(module) if not name.startswith('_')])
+    for name in names:
+        globals()[name] = getattr(module, name)
+
 def add_average_to_weekly_set(weekly_set):
     weekly_totals = {}
     for cohort_weekly_set in weekly_set:
@@ -30,11 +93,186 @@ def add_average_to_weekly_set(weekly_set):
     weekly_set.append({'label': 'Average', 'data': weekly_averages})
     return weekly_set
 
+def downsample_min_max(points, nb_points):
+    '''Keeps the lowest and the highest point of each bucket of consecutive points,
+    so that no peak or dip gets lost - suited to the step charts'''
+
+    if nb_points < 4 or len(points) <= nb_points:
+        return points
+
+    nb_buckets = (nb_points - 2) / 2
+    bucket_size = float(len(points) - 2) / nb_buckets
+    sampled_points = [points[0]]
+    for bucket_nb in xrange(nb_buckets):
+        bucket = points[1 + int(bucket_nb * bucket_size):1 + int((bucket_nb + 1) * bucket_size)]
+        if not bucket:
+            continue
+        low_nb = min(xrange(len(bucket)), key=lambda i: bucket[i][1])
+        high_nb = max(xrange(len(bucket)), key=lambda i: bucket[i][1])
+        for point_nb in sorted(set([low_nb, high_nb])):
+            sampled_points.append(bucket[point_nb])
+    sampled_points.append(points[-1])
+
+    return sampled_points
+
+def downsample_lttb(points, nb_points):
+    '''Largest-Triangle-Three-Buckets: keeps the point of each bucket which forms the
+    largest triangle with the point kept in the previous bucket and the average of
+    the next bucket - follows the shape of the curve closely'''
+
+    if nb_points < 3 or len(points) <= nb_points:
+        return points
+
+    bucket_size = float(len(points) - 2) / (nb_points - 2)
+    sampled_points = [points[0]]
+    prev_x, prev_y = points[0]
+    for bucket_nb in xrange(nb_points - 2):
+        start = 1 + int(bucket_nb * bucket_size)
+        end = 1 + int((bucket_nb + 1) * bucket_size)
+        next_bucket = points[end:min(1 + int((bucket_nb + 2) * bucket_size), len(points))]
+        next_x = float(sum(point[0] for point in next_bucket)) / len(next_bucket)
+        next_y = float(sum(point[1] for point in next_bucket)) / len(next_bucket)
+
+        max_area, max_point = -1, None
+        for point in points[start:end]:
+            area = abs((prev_x - next_x) * (point[1] - prev_y) - (prev_x - point[0]) * (next_y - prev_y))
+            if area > max_area:
+                max_area, max_point = area, point
+        sampled_points.append(max_point)
+        prev_x, prev_y = max_point
+    sampled_points.append(points[-1])
+
+    return sampled_points
+
+downsampling_methods = {'min_max': downsample_min_max,
+                        'lttb': downsample_lttb}
+
+def downsample_series(points, method, nb_points):
+    '''Reduces a series of [timestamp, value] points to at most nb_points, to bound
+    the size of the output and the time the dashboard takes to draw it'''
+
+    if method not in downsampling_methods:
+        raise ValueError('Unknown downsampling method %s, should be one of: %s' %
+                         (method, ', '.join(sorted(downsampling_methods))))
+    return downsampling_methods[method](points, nb_points)
+
+def downsample_dataset(dataset, method, nb_points):
+    return [dict(series, data=downsample_series(series['data'], method, nb_points)) for series in dataset]
+
+def downsample_data(data):
+    '''Copy of the datasets, with the series of those in DOWNSAMPLING downsampled'''
+    data = dict(data)
+    for dataset_name, (method, nb_points) in DOWNSAMPLING.iteritems():
+        if dataset_name in data:
+            data[dataset_name] = downsample_dataset(data[dataset_name], method, nb_points)
+    return data
+
+def process_log_files_partial(log_paths):
+    '''Entry point of the worker processes of ActionSet.process_actions_parallel()'''
+    action_set, consumers, checkpoint, start_date = parallel_context
+    return action_set.process_log_files_partial(log_paths, consumers, checkpoint, start_date)
+
+def iter_lines_threaded(f, read_size):
+    '''Lines of a file, with the next chunk being read (and decompressed) by a
+    background thread while the caller processes the current one'''
+
+    chunks = Queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def read_chunks():
+        try:
+            while not stop.is_set():
+                chunk = f.read(read_size)
+                chunks.put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            chunks.put(e)
+
+    reader = threading.Thread(target=read_chunks)
+    reader.daemon = True
+    reader.start()
+
+    try:
+        remainder = ''
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                break
+
+            lines = (remainder + chunk).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line + '\n'
+
+        if remainder:
+            yield remainder
+    finally:
+        # Unblock the reader if the caller stopped early
+        stop.set()
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+def get_peak_rss(who=resource.RUSAGE_SELF):
+    '''Peak resident set size, in MB'''
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def get_legacy_maps_signature():
+    '''Changes whenever the maps of the legacy player ids are updated'''
+    signature = ''
+    for map_path in [EMAIL2ID_JSON_PATH, NAME2ID_JSON_PATH]:
+        map_stat = os.stat(map_path)
+        signature += '%d:%d:' % (map_stat.st_size, map_stat.st_mtime)
+    return signature
+
+def new_players_set(precision):
+    '''Set of player ids, or a HyperLogLog sketch when a precision is given - both
+    support add(), update() and len()'''
+    if precision is None:
+        return set()
+    return HyperLogLog(precision)
+
+def get_approximate_precision():
+    if APPROXIMATE_COUNTS_ERROR is None:
+        return None
+    return HyperLogLog.get_precision(APPROXIMATE_COUNTS_ERROR)
+
+def new_players_map(spill):
+    '''Map of player id => state - a PlayerStore when spill is set and PLAYERS_MEMORY_BUDGET too'''
+    if not spill or PLAYERS_MEMORY_BUDGET is None:
+        return {}
+    return PlayerStore(PLAYERS_SPILL_PATH, int(PLAYERS_MEMORY_BUDGET * 1024 * 1024))
+
+def restore_players_map(players, spill):
+    '''A players map saved in a checkpoint, moved to a PlayerStore when it was saved without one'''
+    if not isinstance(players, dict) or not spill or PLAYERS_MEMORY_BUDGET is None:
+        return players
+    store = new_players_map(spill)
+    for player_id, state in players.iteritems():
+        store[player_id] = state
+    return store
+
+def get_log_file_fingerprint(first_line):
+    '''Identifies a log file whatever its current name, since rotation renames them'''
+    if not first_line.endswith('\n'):
+        return None # Nothing complete to read from this file yet
+    return hashlib.sha1(first_line).hexdigest()
+
 
 # Classes ################################################################
 
 class TimeSliced(object):
 
+    # Length of the slices counted by get_week_nb_from_date() and iter_weeks() - the
+    # cohorts computed from a DailyRollup can also be sliced per day or per month
+    periods = ('day', 'week', 'month')
+    period = 'week'
+
     def __init__(self):
         # datetime objects
         self.start_date = None
@@ -47,6 +285,10 @@ class TimeSliced(object):
         delta = date2 - date1
         return delta.days / 7
 
+    def seconds_difference(self, date1, date2):
+        delta = date2 - date1
+        return delta.days * 3600 * 24 + delta.seconds
+
     def hours_difference(self, date1, date2):
         delta = date2 - date1
         total_seconds = delta.days * 3600 * 24 + delta.seconds
@@ -57,14 +299,50 @@ class TimeSliced(object):
         total_seconds = delta.days * 3600 * 24 + delta.seconds
         return int(math.floor(total_seconds / 60))
 
+    def periods_difference(self, date1, date2):
+        if self.period == 'week':
+            return self.weeks_difference(date1, date2)
+        elif self.period == 'day':
+            return (date2 - date1).days
+        else:
+            months = (date2.year - date1.year) * 12 + date2.month - date1.month
+            if (date2.day, date2.time()) < (date1.day, date1.time()):
+                months -= 1
+            return months
+
     def get_week_nb_from_date(self, date):
-        return self.weeks_difference(self.start_date, date)
+        if self.period == 'week':
+            return self.weeks_difference(self.start_date, date)
+        return self.periods_difference(self.start_date, date)
+
+    def get_timestamps(self, start_date, step, count):
+        '''Javascript timestamps of count dates step seconds apart - the local time
+        offset only gets computed by mktime() once per hour'''
+        timestamps = []
+        hours_offsets = {}
+        start_second_nb = calendar.timegm(start_date.timetuple())
+
+        for i in xrange(count):
+            second_nb = start_second_nb + i * step
+            hour_nb = second_nb / 3600
+            if hour_nb not in hours_offsets:
+                hour_date = datetime.utcfromtimestamp(hour_nb * 3600)
+                hours_offsets[hour_nb] = int(mktime(hour_date.timetuple())) - hour_nb * 3600
+            timestamps.append((second_nb + hours_offsets[hour_nb]) * 1000)
+
+        return timestamps
 
     def get_date_from_week_nb(self, week_nb):
-        return self.start_date + timedelta(days=7) * week_nb
+        if self.period == 'week':
+            return self.start_date + timedelta(days=7) * week_nb
+        elif self.period == 'day':
+            return self.start_date + timedelta(days=1) * week_nb
+        else:
+            months = self.start_date.month - 1 + week_nb
+            return self.start_date.replace(year=self.start_date.year + months / 12, month=months % 12 + 1)
 
     def iter_weeks(self):
-        total_weeks = self.weeks_difference(self.start_date, self.end_date)
+        total_weeks = self.periods_difference(self.start_date, self.end_date)
         for week_nb in xrange(total_weeks + 1):
             yield week_nb, self.get_date_from_week_nb(week_nb)
 
@@ -116,35 +394,567 @@ class Action(object):
         return role, id
 
 
-class ActionSet(object):
+class ActionRecord(object):
+    '''Compact action, as produced by ActionParser'''
 
-    def __init__(self, start_date):
-        # Caches of emails and name resolution
-        with open(EMAIL2ID_JSON_PATH) as f:
-            self.email2id = json.load(f)
+    __slots__ = ('date', 'role', 'player_id', 'name')
+
+    def __init__(self, date, role, player_id, name):
+        self.date = date
+        self.role = role
+        self.player_id = player_id
+        self.name = name
+
+
+class ActionParser(object):
+    '''Fast equivalent of Action, which remains the reference implementation
+
+    Lines which aren't /resource requests are rejected with a substring search,
+    only the needed parameters get decoded, and the timestamp is parsed without
+    strptime, reusing the previous result when it's the same second.'''
+
+    resource_marker = '/resource?'
+    parameters_names = ('action', 'owner_id', 'player_id')
+
+    def __init__(self, action_set):
+        self.action_set = action_set
+        self.last_timestamp = None
+        self.last_date = None
+
+    def parse(self, line):
+        marker_pos = line.find(self.resource_marker)
+        if marker_pos == -1:
+            return None
+
+        query_start = marker_pos + len(self.resource_marker)
+        query_end = line.find(' ', query_start)
+        if query_end == -1:
+            query = line[query_start:]
+        else:
+            query = line[query_start:query_end]
+
+        parameters = self.get_parameters(query)
+        if parameters is None:
+            return None
+
+        date = self.get_date(line[:19])
+        role, player_id = self.get_role_and_id(parameters)
+        return ActionRecord(date, role, player_id, parameters.get('action'))
+
+    def get_parameters(self, query):
+        '''Same rules as urlparse.parse_qs(), but only keeps the first value of the
+        needed parameters - returns None when parse_qs() would find nothing'''
+
+        found = False
+        parameters = {}
+        if ';' in query:
+            query = query.replace(';', '&')
+
+        for pair in query.split('&'):
+            name, equal, value = pair.partition('=')
+            if not value:
+                continue
+            found = True
+
+            if '%' in name or '+' in name:
+                name = urllib.unquote(name.replace('+', ' '))
+            if name not in self.parameters_names or name in parameters:
+                continue
+
+            if '%' in value or '+' in value:
+                value = urllib.unquote(value.replace('+', ' '))
+            parameters[name] = value
+
+        if not found:
+            return None
+        return parameters
+
+    def get_date(self, timestamp):
+        if timestamp != self.last_timestamp:
+            self.last_date = datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                                      int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]))
+            self.last_timestamp = timestamp
+        return self.last_date
+
+    def get_role_and_id(self, parameters):
+        for role in ('owner', 'player'):
+            id = parameters.get('%s_id' % role)
+            if id is not None:
+                break
+        else:
+            return None, None
+
+        # Check if this is the old format of id, which used to contain the email or name
+        try:
+            id = int(id)
+        except ValueError:
+            id = self.action_set.get_player_id_from_old_id(id)
+
+        return role, id
+
+
+class LegacyIds(object):
+    '''Player ids of the old format of ids, which contained the email or the name
+
+    The email2id.json and name2id.json maps are only read once a legacy id shows up.
+    With a path, they are converted once to a sqlite database, which is then queried
+    rather than loaded. The ids looked up are memoized, in a cache of memo_size ids.'''
+
+    memo_size = 10000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.maps = None # (name2id, email2id), when there is no database
+        self.db = None
+        self.db_pid = None
+        self.memo = OrderedDict()
+
+    def get_player_id(self, old_id):
+        if old_id in self.memo:
+            player_id = self.memo.pop(old_id)
+        else:
+            player_id = self.lookup(old_id)
+            if len(self.memo) >= self.memo_size:
+                self.memo.popitem(last=False) # Least recently used
+        self.memo[old_id] = player_id
+        return player_id
+
+    def lookup(self, old_id):
+        if not self.path:
+            if self.maps is None:
+                self.maps = self.load_maps()
+            name2id, email2id = self.maps
+            if old_id in name2id:
+                return name2id[old_id][0]
+            return email2id.get(old_id)
+
+        try:
+            old_id = old_id.decode('ascii')
+        except UnicodeDecodeError:
+            return None # Never matched the unicode keys of the maps either
+        row = self.get_db().execute('SELECT player_id FROM legacy_ids WHERE old_id = ?', (old_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def load_maps(self):
         with open(NAME2ID_JSON_PATH) as f:
-            self.name2id = json.load(f)
+            name2id = json.load(f)
+        with open(EMAIL2ID_JSON_PATH) as f:
+            email2id = json.load(f)
+        return name2id, email2id
+
+    def get_db(self):
+        # A connection can't be used by the worker processes it was forked to
+        if self.db is None or self.db_pid != os.getpid():
+            self.db = self.open_db(get_legacy_maps_signature())
+            self.db_pid = os.getpid()
+        return self.db
+
+    def open_db(self, signature):
+        if os.path.exists(self.path):
+            db = sqlite3.connect(self.path)
+            try:
+                row = db.execute("SELECT value FROM meta WHERE name = 'signature'").fetchone()
+            except sqlite3.DatabaseError:
+                row = None
+            if row is not None and row[0] == signature:
+                return db
+            db.close()
+
+        self.build_db(signature)
+        return sqlite3.connect(self.path)
+
+    def build_db(self, signature):
+        name2id, email2id = self.load_maps()
+
+        # Each process builds its own, if several of them find it missing
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        db = sqlite3.connect(tmp_path)
+        db.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE legacy_ids (old_id TEXT PRIMARY KEY, player_id INTEGER)')
+        # The names take precedence over the emails
+        db.executemany('INSERT OR REPLACE INTO legacy_ids VALUES (?, ?)', email2id.iteritems())
+        db.executemany('INSERT OR REPLACE INTO legacy_ids VALUES (?, ?)',
+                       ((name, ids[0]) for name, ids in name2id.iteritems()))
+        db.execute("INSERT INTO meta VALUES ('signature', ?)", (signature,))
+        db.commit()
+        db.close()
+        os.rename(tmp_path, self.path)
+
+
+class PlayerStore(object):
+    '''Map of player id => state which keeps about max_size bytes of them in memory,
+    the others being spilled to a scratch sqlite database, and loaded back when they
+    show up again. Supports the methods of dict used by the consumers.
+
+    The players seen recently stay in memory, through generations of plain dicts
+    rather than a strict LRU, which would cost more on every action: once the young
+    generation is full, the players of the old one who haven't shown up since are
+    spilled, and the young generation becomes the old one. As the states can grow in
+    place, the size of the young generation is measured again from time to time.'''
+
+    # About the memory used by a player in a dict, key and state included, in bytes
+    player_size = 200
+    # Added by each item of a state which is a list, like the actions kept by the funnel
+    item_size = 128
+    missing = object()
+
+    def __init__(self, directory=None, max_size=20 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.young = {}
+        self.old = {}
+        # Number of players in the young generation at which its size is measured, from the
+        # average size of the players when it was last measured
+        self.next_check = 1
+        self.average_size = self.player_size
+        self.db = None
+
+    def __reduce__(self):
+        # Pickled as the items of a dict, written one by one to the new store when loaded
+        return (new_players_map, (True,), None, None, self.iteritems())
+
+    def get_db(self):
+        if self.db is None:
+            fd, path = tempfile.mkstemp(prefix='cardstories_players_', suffix='.sqlite', dir=self.directory)
+            os.close(fd)
+            # A store loaded from the result of a worker is filled by the thread of the pool
+            # which receives it, and then used by the main thread
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode = OFF')
+            self.db.execute('PRAGMA synchronous = OFF')
+            # Keyed by the ids as strings, as sqlite never finds a NULL key
+            self.db.execute('CREATE TABLE players (key TEXT PRIMARY KEY, player_id, state BLOB)')
+            # Scratch data, which is only needed as long as the database is open
+            os.remove(path)
+        return self.db
+
+    def get(self, player_id, default=None):
+        state = self.young.get(player_id, self.missing)
+        if state is not self.missing:
+            return state
+
+        state = self.old.get(player_id, self.missing)
+        if state is self.missing:
+            if self.db is None:
+                return default
+            row = self.db.execute('SELECT state FROM players WHERE key = ?', (str(player_id),)).fetchone()
+            if row is None:
+                return default
+            state = cPickle.loads(str(row[0]))
+        self[player_id] = state
+        return state
+
+    def __setitem__(self, player_id, state):
+        if player_id not in self.young:
+            self.old.pop(player_id, None)
+            if len(self.young) >= self.next_check:
+                self.check_size()
+        self.young[player_id] = state
+
+    def get_state_size(self, state):
+        if isinstance(state, list):
+            return self.player_size + self.item_size * len(state)
+        return self.player_size
+
+    def check_size(self):
+        '''Spills the old generation once the young one takes half of max_size'''
+
+        young_size = sum(self.get_state_size(state) for state in self.young.itervalues())
+        if self.young:
+            self.average_size = young_size / len(self.young)
+        if young_size >= self.max_size / 2:
+            self.spill()
+            young_size = 0
+        self.next_check = len(self.young) + max((self.max_size / 2 - young_size) / self.average_size, 1)
+
+    def spill(self):
+        if self.old:
+            self.get_db().executemany('INSERT OR REPLACE INTO players VALUES (?, ?, ?)',
+                                      ((str(player_id), player_id,
+                                        sqlite3.Binary(cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)))
+                                       for player_id, state in self.old.iteritems()))
+        self.old = self.young
+        self.young = {}
+
+    def iteritems(self):
+        for item in self.young.iteritems():
+            yield item
+        for item in self.old.iteritems():
+            yield item
+        if self.db is not None:
+            for player_id, state in self.db.execute('SELECT player_id, state FROM players'):
+                if player_id not in self.young and player_id not in self.old:
+                    yield player_id, cPickle.loads(str(state))
+
+
+class RunMetrics(object):
+    '''Wall time, CPU time and peak memory of each stage of a run, along with counters
+    of the lines and actions read. When disabled, the stages and counters are no-ops.'''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start_time = time.time()
+        self.stages = OrderedDict()
+        self.counters = {'lines_read': 0,       # Lines read from the log files
+                         'lines_rejected': 0,   # Lines which aren't webservice calls
+                         'actions_cached': 0,   # Actions read from the action cache
+                         'actions_accepted': 0, # Actions handed to the consumers
+                         'actions_rejected': 0} # Actions outside of the processed dates
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        self.get_stage(name) # Stages are listed in the order they start
+        start_time, start_cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.time() - start_time, time.clock() - start_cpu)
+
+    def get_stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = {'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss': 0.0}
+        return self.stages[name]
+
+    def add_stage_time(self, name, wall_time, cpu_time):
+        self.get_stage(name)
+        self.stages[name]['wall_time'] += wall_time
+        self.stages[name]['cpu_time'] += cpu_time
+        self.stages[name]['peak_rss'] = get_peak_rss()
+
+    def get_state(self):
+        return {'counters': self.counters, 'stages': self.stages}
+
+    def merge_state(self, state):
+        '''Adds the counters and stages times of a worker process'''
+        for name, count in state['counters'].iteritems():
+            self.counters[name] += count
+        for name, stage in state['stages'].iteritems():
+            self.add_stage_time(name, stage['wall_time'], stage['cpu_time'])
+
+    def get_meta(self):
+        stages = []
+        for name, stage in self.stages.iteritems():
+            stages.append({'name': name,
+                           'wall_time': round(stage['wall_time'], 3),
+                           'cpu_time': round(stage['cpu_time'], 3),
+                           'peak_rss': round(stage['peak_rss'], 1)})
+
+        return {'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'wall_time': round(time.time() - self.start_time, 3),
+                'peak_rss': round(get_peak_rss(), 1),
+                'peak_rss_workers': round(get_peak_rss(resource.RUSAGE_CHILDREN), 1),
+                'counters': dict(self.counters),
+                'stages': stages}
+
+
+class ActionSet(object):
+
+    compressed_suffixes = ('.gz', '.bz2', '.xz')
+    read_size = 1024 * 1024 # Size of the chunks read from the compressed logs
+
+    def __init__(self, start_date, reference_parser=False, metrics=None):
+        # Emails and names resolution, loaded on the first legacy id
+        self.legacy_ids = LegacyIds(LEGACY_IDS_PATH)
 
         self.start_date = start_date
+        # Date of the last action, tracked while the actions are processed
         self.end_date = None
-        self.end_date = self.get_end_date()
 
-    def get_end_date(self):
-        '''Find out end of log data'''
+        if reference_parser:
+            self.parse_line = self.parse_line_reference
+        else:
+            self.parse_line = ActionParser(self).parse
+
+        if ACTION_CACHE_PATH:
+            self.action_cache = ActionCache(ACTION_CACHE_PATH)
+        else:
+            self.action_cache = None
+
+        if LOG_INDEX_PATH:
+            self.log_index = LogIndex(LOG_INDEX_PATH)
+        else:
+            self.log_index = None
+
+        if metrics is None:
+            metrics = RunMetrics(enabled=False)
+        self.metrics = metrics
+
+    def process_actions(self, consumers, checkpoint=None, jobs=1, start_date=None):
+        '''Read the logs once, handing each action to all the consumers - only those
+        from start_date on when it is given, skipping the older log files
 
-        end_date = datetime(1900, 1, 1, 0, 0, 0)
+        With a checkpoint, the consumers resume from their saved state, and only
+        the lines which haven't been processed yet are read.
 
-        for action in self.iter_actions():
-            if action.date > end_date:
-                end_date = action.date
+        With several jobs, the log files are split between worker processes, which
+        each feed their own partial consumers. Their states are then merged in
+        chronological order into the consumers.
 
-        return end_date
+        With metrics enabled, the time spent in each consumer is recorded in its
+        own stage, and the rest of the pass in the ActionSet stage.'''
+
+        if checkpoint:
+            with self.metrics.stage('Checkpoint'):
+                checkpoint.restore(self, consumers)
+
+        self.process_new_actions(consumers, checkpoint=checkpoint, jobs=jobs, start_date=start_date)
+
+        if checkpoint:
+            with self.metrics.stage('Checkpoint'):
+                checkpoint.save(self, consumers)
+
+    def process_new_actions(self, consumers, checkpoint=None, jobs=1, start_date=None):
+        '''Hands the actions the checkpoint hasn't seen yet to the consumers, without
+        restoring or saving it - the follow mode calls it on each update'''
+
+        with self.metrics.stage('ActionSet'):
+            if self.action_cache:
+                self.action_cache.used_fingerprints = set()
+
+            if jobs > 1:
+                self.process_actions_parallel(consumers, checkpoint, jobs, start_date)
+            else:
+                actions = self.iter_actions(start_date=start_date, checkpoint=checkpoint,
+                                            log_paths=self.get_log_files(start_date))
+                if self.metrics.enabled:
+                    self.record_actions_timed(actions, consumers, parent_stage='ActionSet')
+                else:
+                    self.record_actions(actions, consumers)
+
+            # From a start date, the older log files aren't listed, so their segments aren't known to be used
+            if self.action_cache and start_date is None:
+                self.action_cache.remove_unused_segments()
+            if self.log_index:
+                self.log_index.save()
+
+    def record_actions(self, actions, consumers):
+        for action in actions:
+            if self.end_date is None or action.date > self.end_date:
+                self.end_date = action.date
+
+            for consumer in consumers:
+                consumer.record_action(action)
+
+    def record_actions_timed(self, actions, consumers, parent_stage=None):
+        '''Same as record_actions(), recording the time spent in each consumer. This
+        time is taken out of parent_stage, when the loop runs within that stage.'''
+
+        wall_times = [0.0] * len(consumers)
+        cpu_times = [0.0] * len(consumers)
+        for action in actions:
+            if self.end_date is None or action.date > self.end_date:
+                self.end_date = action.date
+
+            for i, consumer in enumerate(consumers):
+                start_time, start_cpu = time.time(), time.clock()
+                consumer.record_action(action)
+                wall_times[i] += time.time() - start_time
+                cpu_times[i] += time.clock() - start_cpu
+
+        if parent_stage:
+            self.metrics.add_stage_time(parent_stage, -sum(wall_times), -sum(cpu_times))
+        for consumer, wall_time, cpu_time in zip(consumers, wall_times, cpu_times):
+            self.metrics.add_stage_time(consumer.__class__.__name__, wall_time, cpu_time)
+
+    def process_actions_parallel(self, consumers, checkpoint, jobs, start_date=None):
+        global parallel_context
+
+        log_paths = self.get_log_files(start_date)
+        if not log_paths:
+            return
+        nb_chunks = min(len(log_paths), jobs * 4)
+        chunks = [log_paths[len(log_paths) * i / nb_chunks:len(log_paths) * (i + 1) / nb_chunks]
+                  for i in xrange(nb_chunks)]
+
+        # The workers get the context by being forked, rather than through pickling
+        parallel_context = (self, consumers, checkpoint, start_date)
+        pool = multiprocessing.Pool(jobs)
+        try:
+            for result_path in pool.imap(process_log_files_partial, chunks):
+                result = self.load_partial_result(result_path)
+                if result['end_date'] and (self.end_date is None or result['end_date'] > self.end_date):
+                    self.end_date = result['end_date']
+                for consumer, state in zip(consumers, result['states']):
+                    consumer.merge_state(state)
+                if checkpoint:
+                    checkpoint.offsets.update(result['offsets'])
+                    checkpoint.finished.update(result['finished'])
+                if self.action_cache:
+                    self.action_cache.used_fingerprints.update(result['used_fingerprints'])
+                if result['metrics']:
+                    self.metrics.merge_state(result['metrics'])
+            pool.close()
+        finally:
+            pool.terminate()
+            parallel_context = None
+
+    def process_log_files_partial(self, log_paths, consumers, checkpoint, start_date=None):
+        '''Runs in a worker process, with a forked copy of the action set'''
+
+        self.end_date = None
+        partial_consumers = [consumer.get_partial() for consumer in consumers]
+        if checkpoint:
+            previous_offsets = checkpoint.offsets
+            checkpoint.offsets = dict(previous_offsets)
+            previous_finished = checkpoint.finished
+            checkpoint.finished = set(previous_finished)
+        if self.action_cache:
+            self.action_cache.used_fingerprints = set()
+
+        actions = self.iter_actions(start_date=start_date, checkpoint=checkpoint, log_paths=log_paths)
+        if self.metrics.enabled:
+            # The consumers are timed across all the workers, the ActionSet stage by the parent
+            self.metrics = RunMetrics()
+            self.record_actions_timed(actions, partial_consumers)
+        else:
+            self.record_actions(actions, partial_consumers)
+
+        # Only the offsets of the files of this worker, to not revert those of the others
+        offsets = {}
+        finished = set()
+        if checkpoint:
+            for fingerprint, offset in checkpoint.offsets.iteritems():
+                if previous_offsets.get(fingerprint) != offset:
+                    offsets[fingerprint] = offset
+            finished = checkpoint.finished - previous_finished
+
+        result = {'end_date': self.end_date,
+                  'states': [consumer.get_state() for consumer in partial_consumers],
+                  'offsets': offsets,
+                  'finished': finished,
+                  'used_fingerprints': self.action_cache.used_fingerprints if self.action_cache else None,
+                  'metrics': self.metrics.get_state() if self.metrics.enabled else None}
+
+        # Through a scratch file rather than the pipe of the pool, for the spilled players
+        # to be streamed instead of being pickled to a single string in both processes
+        fd, result_path = tempfile.mkstemp(prefix='cardstories_partial_', suffix='.pickle', dir=PLAYERS_SPILL_PATH)
+        with os.fdopen(fd, 'wb') as f:
+            pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+            # Without the memo, which would keep all the objects pickled
+            pickler.fast = True
+            pickler.dump(result)
+        return result_path
+
+    def load_partial_result(self, result_path):
+        try:
+            with open(result_path, 'rb') as f:
+                return cPickle.load(f)
+        finally:
+            os.remove(result_path)
 
     def iter_log_files(self):
         log_dir, log_file_base = os.path.split(WS_LOG_PATH)
         log_path_list = []
         for filename in os.listdir(log_dir):
-            m = re.match('%s\.(\d+)' % log_file_base, filename)
+            m = re.match(r'%s\.(\d+)(\.gz|\.bz2|\.xz)?$' % re.escape(log_file_base), filename)
             if m:
                 log_num = int(m.group(1))
                 log_path_list.append([log_num, filename])
@@ -157,73 +967,754 @@ class ActionSet(object):
         for log_num, log_path in log_path_list:
             yield os.path.join(log_dir, log_path)
 
-    def iter_actions(self, start_date=None, end_date=None):
+    def get_log_files(self, start_date=None):
+        '''Log files, from the oldest to the newest - without those which only have lines
+        from before start_date, as the lines of a rotated log are all older than the
+        first line of the next one'''
+
+        log_paths = list(self.iter_log_files())
+        if start_date is None:
+            return log_paths
+
+        if self.log_index:
+            # Indexes the files to read on the way, for iter_log_lines() to seek to start_date
+            for log_nb in xrange(len(log_paths) - 1, -1, -1):
+                entry = self.get_log_file_index(log_paths[log_nb])
+                if entry is not None and entry['last_date'] is not None and entry['last_date'] < start_date:
+                    return log_paths[log_nb + 1:]
+            return log_paths
+
+        for log_nb in xrange(len(log_paths) - 1, -1, -1):
+            first_date = self.get_log_file_first_date(log_paths[log_nb])
+            if first_date is not None and first_date < start_date:
+                return log_paths[log_nb:]
+        return log_paths
+
+    def get_log_file_index(self, log_path):
+        '''Index entry of a log file, once the lines added since the last time are indexed'''
+
+        with self.open_log_file(log_path) as f:
+            fingerprint = get_log_file_fingerprint(f.readline())
+            if fingerprint is None:
+                return None
+
+            entry = self.log_index.get_entry(fingerprint)
+            if not entry['finished']:
+                f.seek(entry['size'])
+                self.log_index.add_lines(entry, self.iter_file_lines(f, log_path))
+                # Rotated logs aren't written to anymore
+                entry['finished'] = not self.is_live_log(log_path)
+        return entry
+
+    def get_log_file_first_date(self, log_path):
+        with self.open_log_file(log_path) as f:
+            first_line = f.readline()
+        try:
+            return datetime.strptime(first_line[:19], '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return None
+
+    def get_end_date(self):
+        '''Date of the last action of the logs, read from the end of the newest log files,
+        before the actions are processed'''
+
+        for log_path in reversed(self.get_log_files()):
+            end_date = self.get_log_file_end_date(log_path)
+            if end_date is not None:
+                return end_date
+        return None
+
+    def get_log_file_end_date(self, log_path):
+        with self.open_log_file(log_path) as f:
+            if log_path.endswith(self.compressed_suffixes):
+                # Can't be read backwards, but rotated logs are only reached when the newer ones are empty
+                end_date = None
+                for line in self.iter_file_lines(f, log_path):
+                    action = self.parse_line(line)
+                    if action is not None:
+                        end_date = action.date
+                return end_date
+
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            while end > 0:
+                start = max(0, end - self.read_size)
+                f.seek(start)
+                lines = f.read(end - start).split('\n')
+                if start > 0:
+                    # Cut in the middle, read again with the previous chunk
+                    end = start + len(lines.pop(0))
+                else:
+                    end = 0
+
+                for line in reversed(lines):
+                    action = self.parse_line(line)
+                    if action is not None:
+                        return action.date
+        return None
+
+    def is_live_log(self, log_path):
+        return os.path.basename(log_path) == os.path.basename(WS_LOG_PATH)
+
+    def open_log_file(self, log_path):
+        '''Rotated logs can be compressed by logrotate'''
+        if log_path.endswith('.gz'):
+            return gzip.GzipFile(log_path, 'rb')
+        elif log_path.endswith('.bz2'):
+            return bz2.BZ2File(log_path, 'rb', self.read_size)
+        elif log_path.endswith('.xz'):
+            if lzma is None:
+                raise ImportError('Reading %s requires the lzma module (backports.lzma)' % log_path)
+            return lzma.LZMAFile(log_path, 'rb')
+        else:
+            return open(log_path)
+
+    def iter_file_lines(self, f, log_path):
+        if log_path.endswith(self.compressed_suffixes):
+            return iter_lines_threaded(f, self.read_size)
+        else:
+            return f
+
+    def iter_lines(self, checkpoint=None):
         for log_path in self.iter_log_files():
-            with open(log_path) as f:
-                for line in f:
-                    action = Action(self, line)
-                    if not action.parameters:
-                        continue
-                    if action.date < self.start_date or \
-                            (start_date and action.date < start_date):
-                        continue
-                    if (self.end_date and action.date > self.end_date) or \
-                            (end_date and action.date >= end_date):
-                        continue
+            for line in self.iter_log_lines(log_path, checkpoint=checkpoint):
+                yield line
+
+    def iter_log_lines(self, log_path, checkpoint=None, start_date=None):
+        '''With start_date, can skip the lines which are known to be older, from the
+        log index built by get_log_files()'''
+
+        with self.open_log_file(log_path) as f:
+            fingerprint = None
+            start_offset = 0
+            if checkpoint or (start_date and self.log_index):
+                fingerprint = get_log_file_fingerprint(f.readline())
+                if fingerprint is None:
+                    return
+                if start_date and self.log_index:
+                    start_offset = self.log_index.get_offset(fingerprint, start_date)
+
+            if not checkpoint:
+                f.seek(start_offset)
+                for line in self.iter_file_lines(f, log_path):
+                    yield line
+                return
+
+            if checkpoint.is_finished(fingerprint):
+                return
+            offset = max(checkpoint.get_offset(fingerprint), start_offset)
+            f.seek(offset)
+
+            for line in self.iter_file_lines(f, log_path):
+                if not line.endswith('\n'):
+                    break # Still being written, will be read on the next run
+                offset += len(line)
+                yield line
+
+            checkpoint.set_offset(fingerprint, offset)
+            if not self.is_live_log(log_path):
+                # Rotated logs aren't written to anymore, no need to seek through them again
+                checkpoint.set_finished(fingerprint)
+
+    def iter_log_actions(self, log_path, start_date=None, end_date=None, checkpoint=None):
+        '''Actions of a single log file, read from the action cache when possible'''
+
+        if self.action_cache is None or self.is_live_log(log_path):
+            for action in self.parse_lines(self.iter_log_lines(log_path, checkpoint=checkpoint,
+                                                               start_date=start_date)):
+                yield action
+            return
+
+        with self.open_log_file(log_path) as f:
+            fingerprint = get_log_file_fingerprint(f.readline())
+        if fingerprint is None:
+            return
+        self.action_cache.used_fingerprints.add(fingerprint)
+
+        if checkpoint and checkpoint.is_finished(fingerprint):
+            return
+        if checkpoint and checkpoint.get_offset(fingerprint) > 0:
+            # Already processed up to some point, when it was still the live log
+            for action in self.parse_lines(self.iter_log_lines(log_path, checkpoint=checkpoint,
+                                                               start_date=start_date)):
+                yield action
+            return
+
+        counters = self.metrics.counters if self.metrics.enabled else None
+        segment = self.action_cache.open_segment(fingerprint)
+        if segment is not None:
+            try:
+                for action in segment.iter_actions(start_date=start_date, end_date=end_date):
+                    if counters is not None:
+                        counters['actions_cached'] += 1
+                    yield action
+                offset = segment.offset
+            finally:
+                segment.close()
+        else:
+            segment_writer = ActionSegmentWriter()
+            offset = 0
+            with self.open_log_file(log_path) as f:
+                for line in self.iter_file_lines(f, log_path):
+                    if not line.endswith('\n'):
+                        break
+                    offset += len(line)
+                    action = self.parse_line(line)
+                    if counters is not None:
+                        counters['lines_read'] += 1
+                        counters['lines_rejected'] += action is None
+                    if action is not None:
+                        segment_writer.add(action)
+                        yield action
+            self.action_cache.save_segment(fingerprint, segment_writer, offset)
+
+        if checkpoint:
+            checkpoint.set_offset(fingerprint, offset)
+            checkpoint.set_finished(fingerprint)
+
+    def parse_lines(self, lines):
+        if not self.metrics.enabled:
+            for line in lines:
+                action = self.parse_line(line)
+                if action is not None:
                     yield action
+            return
+
+        counters = self.metrics.counters
+        for line in lines:
+            action = self.parse_line(line)
+            counters['lines_read'] += 1
+            if action is not None:
+                yield action
+            else:
+                counters['lines_rejected'] += 1
+
+    def parse_line_reference(self, line):
+        action = Action(self, line)
+        if not action.parameters:
+            return None
+        return action
+
+    def iter_parser_mismatches(self):
+        '''Lines on which ActionParser doesn't agree with the reference Action'''
+
+        action_parser = ActionParser(self)
+        for line in self.iter_lines():
+            reference = self.parse_line_reference(line)
+            action = action_parser.parse(line)
+            if reference is None and action is None:
+                continue
+            if reference is None or action is None or \
+                    (reference.date, reference.role, reference.player_id, reference.name) != \
+                    (action.date, action.role, action.player_id, action.name):
+                yield line
+
+    def iter_actions(self, start_date=None, end_date=None, checkpoint=None, log_paths=None):
+        if log_paths is None:
+            log_paths = self.get_log_files(start_date)
+        if start_date is None or start_date < self.start_date:
+            start_date = self.start_date
+
+        counters = self.metrics.counters if self.metrics.enabled else None
+        for log_path in log_paths:
+            for action in self.iter_log_actions(log_path, start_date=start_date, end_date=end_date,
+                                                checkpoint=checkpoint):
+                if action.date < start_date or (end_date and action.date >= end_date):
+                    if counters is not None:
+                        counters['actions_rejected'] += 1
+                    continue
+                if counters is not None:
+                    counters['actions_accepted'] += 1
+                yield action
 
     def get_player_id_from_old_id(self, email_or_name):
-        if email_or_name in self.name2id:
-            return self.name2id[email_or_name][0]
-        elif email_or_name in self.email2id:
-            return self.email2id[email_or_name]
+        return self.legacy_ids.get_player_id(email_or_name)
+
+
+class Checkpoint(object):
+    '''State of the consumers and position reached in each log file, saved
+    at the end of a run so that the next one only reads the new lines
+
+    A run with only some of the consumers of the saved checkpoint restores
+    their states from it, but doesn't replace it with its smaller one.'''
+
+    version = 6
+
+    def __init__(self, path=None):
+        # Without a path, the checkpoint only lives in memory, for the follow mode
+        self.path = path
+        # Log file fingerprint => number of bytes already processed
+        self.offsets = {}
+        # Fingerprints of the rotated logs which have been read to the end
+        self.finished = set()
+        # Classes of the consumers of the saved checkpoint, which a save must keep
+        self.saved_classes = set()
+
+    def get_offset(self, fingerprint):
+        return self.offsets.get(fingerprint, 0)
+
+    def set_offset(self, fingerprint, offset):
+        self.offsets[fingerprint] = offset
+
+    def is_finished(self, fingerprint):
+        return fingerprint in self.finished
+
+    def set_finished(self, fingerprint):
+        self.finished.add(fingerprint)
+
+    def get_consumers_names(self, consumers):
+        # Consumers whose state depends on their settings expose them in checkpoint_key
+        return [(consumer.__class__.__name__, getattr(consumer, 'checkpoint_key', None))
+                for consumer in consumers]
+
+    def restore(self, action_set, consumers):
+        if not self.path or not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            checkpoint = cPickle.load(f)
+
+        # Start over when the saved state doesn't match the current run
+        if checkpoint['version'] != self.version or \
+                checkpoint['start_date'] != action_set.start_date:
+            return
+        self.saved_classes = set(name for name, key in checkpoint['consumers'])
+
+        states = []
+        for consumer_name in self.get_consumers_names(consumers):
+            if consumer_name not in checkpoint['consumers']:
+                return
+            states.append(checkpoint['states'][checkpoint['consumers'].index(consumer_name)])
+
+        self.offsets = checkpoint['offsets']
+        self.finished = checkpoint['finished']
+        action_set.end_date = checkpoint['end_date']
+        for consumer, state in zip(consumers, states):
+            consumer.set_state(state)
+
+    def save(self, action_set, consumers):
+        if not self.path:
+            return
+        consumers_classes = set(consumer.__class__.__name__ for consumer in consumers)
+        if not self.saved_classes <= consumers_classes:
+            logger.info('Not saving the checkpoint, which has more consumers than this run')
+            return
+
+        checkpoint = {'version': self.version,
+                      'start_date': action_set.start_date,
+                      'end_date': action_set.end_date,
+                      'consumers': self.get_consumers_names(consumers),
+                      'states': [consumer.get_state() for consumer in consumers],
+                      'offsets': self.offsets,
+                      'finished': self.finished}
+
+        # Write to a temporary file first, to never leave a truncated checkpoint behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+
+
+class LogIndex(object):
+    '''Dates of the lines of each log file, saved between runs: the first and last
+    ones, and the offset of the first line of each hour. Reading from a date then
+    skips the older files, and seeks close to the date in the others.
+
+    Twisted writes its log in chronological order, so the hours only go forward.'''
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        # Log file fingerprint => entry
+        self.entries = {}
+        self.used_fingerprints = set()
+        self.changed = False
+
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                index = cPickle.load(f)
+            if index['version'] == self.version:
+                self.entries = index['entries']
+
+    def get_entry(self, fingerprint):
+        self.used_fingerprints.add(fingerprint)
+        if fingerprint not in self.entries:
+            self.entries[fingerprint] = {'size': 0,         # Bytes indexed, up to the last complete line
+                                         'first_date': None,
+                                         'last_date': None,
+                                         'last_hour': None, # Beginning of the timestamp of the last hour
+                                         'hours': [],       # (hour, offset of its first line)
+                                         'finished': False} # Rotated and fully indexed
+        return self.entries[fingerprint]
+
+    def add_lines(self, entry, lines):
+        offset = entry['size']
+        last_hour = entry['last_hour']
+        last_timestamp = None
+        for line in lines:
+            if not line.endswith('\n'):
+                break # Still being written
+
+            if line[:13] == last_hour:
+                last_timestamp = line[:19]
+            else:
+                try:
+                    date = datetime.strptime(line[:19], '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    pass # Continuation of a multiline message
+                else:
+                    last_timestamp = line[:19]
+                    if entry['first_date'] is None:
+                        entry['first_date'] = date
+                    if last_hour is None or line[:13] > last_hour:
+                        entry['hours'].append((date.replace(minute=0, second=0), offset))
+                        last_hour = line[:13]
+            offset += len(line)
+
+        if offset != entry['size']:
+            entry['size'] = offset
+            entry['last_hour'] = last_hour
+            if last_timestamp is not None:
+                entry['last_date'] = datetime.strptime(last_timestamp, '%Y-%m-%d %H:%M:%S')
+            self.changed = True
+
+    def get_offset(self, fingerprint, date):
+        '''Offset of a line before any line from the date on'''
+        entry = self.entries.get(fingerprint)
+        if entry is None:
+            return 0
+
+        hour = date.replace(minute=0, second=0, microsecond=0)
+        hour_nb = bisect.bisect_right(entry['hours'], (hour, sys.maxint)) - 1
+        if hour_nb < 0:
+            return 0
+        return entry['hours'][hour_nb][1]
+
+    def save(self):
+        '''Only keeps the entries of the log files looked at in this run'''
+
+        if not self.used_fingerprints:
+            return # Not used in this run
+        if not self.changed and len(self.used_fingerprints) == len(self.entries):
+            return
+
+        self.entries = dict((fingerprint, entry) for fingerprint, entry in self.entries.iteritems()
+                            if fingerprint in self.used_fingerprints)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump({'version': self.version, 'entries': self.entries}, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+        self.changed = False
+
+
+class ActionSegmentWriter(object):
+    '''Accumulates the columns of an ActionSegment while a log file is parsed'''
+
+    def __init__(self):
+        self.dates = []
+        self.player_ids = []
+        self.roles = []
+        self.names = []
+        self.names_codes = {None: 0}
+
+    def add(self, action):
+        self.dates.append(calendar.timegm(action.date.timetuple()))
+        if action.player_id is None:
+            self.player_ids.append(ActionSegment.no_player_id)
         else:
+            self.player_ids.append(action.player_id)
+        self.roles.append(ActionSegment.roles.index(action.role))
+
+        if action.name not in self.names_codes:
+            self.names_codes[action.name] = len(self.names_codes)
+        self.names.append(self.names_codes[action.name])
+
+    def get_names_list(self):
+        names_list = [None] * len(self.names_codes)
+        for name, code in self.names_codes.iteritems():
+            names_list[code] = name
+        return names_list
+
+    def write(self, f, offset):
+        count = len(self.dates)
+        is_sorted = all(self.dates[i] <= self.dates[i + 1] for i in xrange(count - 1))
+        names_json = json.dumps(self.get_names_list())
+
+        header = struct.pack(ActionSegment.header_format, ActionSegment.magic, ActionSegment.version,
+                             count, offset, int(is_sorted), len(names_json))
+        f.write(header)
+        f.write(names_json)
+        f.write('\0' * ActionSegment.get_padding(len(header) + len(names_json)))
+        f.write(struct.pack('<%dq' % count, *self.dates))
+        f.write(struct.pack('<%di' % count, *self.player_ids))
+        f.write(struct.pack('<%dB' % count, *self.roles))
+        f.write(struct.pack('<%dB' % count, *self.names))
+
+
+class ActionSegment(object):
+    '''Actions of one rotated log file, stored as fixed-width columns (epoch
+    seconds, player ids, role codes, action name codes) and read through mmap'''
+
+    magic = 'CSAS'
+    version = 1
+    # magic, version, number of actions, bytes of the log file read, dates sorted, size of names
+    header_format = '<4sIQQII'
+    roles = [None, 'owner', 'player']
+    no_player_id = -1
+    max_names = 256
+    chunk_size = 4096
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count, self.offset, self.is_sorted, names_size = \
+                struct.unpack_from(self.header_format, self.map)
+        if magic != self.magic or version != self.version:
+            self.close()
+            raise ValueError('Unsupported action segment: %s' % path)
+
+        header_size = struct.calcsize(self.header_format)
+        self.names = json.loads(self.map[header_size:header_size + names_size])
+
+        self.dates_pos = header_size + names_size + self.get_padding(header_size + names_size)
+        self.player_ids_pos = self.dates_pos + 8 * self.count
+        self.roles_pos = self.player_ids_pos + 4 * self.count
+        self.names_pos = self.roles_pos + self.count
+
+    @staticmethod
+    def get_padding(size):
+        '''Keeps the columns aligned on 8 bytes'''
+        return -size % 8
+
+    def close(self):
+        self.map.close()
+
+    def get_timestamp(self, action_nb):
+        return struct.unpack_from('<q', self.map, self.dates_pos + 8 * action_nb)[0]
+
+    def find_action_nb(self, date):
+        '''Number of the first action at or after date, by bisection of the sorted dates'''
+        timestamp = calendar.timegm(date.timetuple())
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def iter_actions(self, start_date=None, end_date=None):
+        first_action_nb, last_action_nb = 0, self.count
+        if self.is_sorted:
+            if start_date:
+                first_action_nb = self.find_action_nb(start_date)
+            if end_date:
+                last_action_nb = self.find_action_nb(end_date)
+
+        epoch = datetime(1970, 1, 1)
+        last_timestamp, last_date = None, None
+        for chunk_start in xrange(first_action_nb, last_action_nb, self.chunk_size):
+            chunk_size = min(self.chunk_size, last_action_nb - chunk_start)
+            timestamps = struct.unpack_from('<%dq' % chunk_size, self.map, self.dates_pos + 8 * chunk_start)
+            player_ids = struct.unpack_from('<%di' % chunk_size, self.map, self.player_ids_pos + 4 * chunk_start)
+            roles = struct.unpack_from('<%dB' % chunk_size, self.map, self.roles_pos + chunk_start)
+            names = struct.unpack_from('<%dB' % chunk_size, self.map, self.names_pos + chunk_start)
+
+            for i in xrange(chunk_size):
+                if timestamps[i] != last_timestamp:
+                    last_timestamp = timestamps[i]
+                    last_date = epoch + timedelta(seconds=last_timestamp)
+                player_id = player_ids[i]
+                if player_id == self.no_player_id:
+                    player_id = None
+                yield ActionRecord(last_date, self.roles[roles[i]], player_id, self.names[names[i]])
+
+
+class ActionCache(object):
+    '''Directory of ActionSegment files, one per rotated log file
+
+    Segments are named after the log file fingerprint and the legacy id maps
+    they were resolved with, so they are rebuilt whenever those maps change.'''
+
+    suffix = '.segment'
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.maps_signature = get_legacy_maps_signature()
+
+        # Fingerprints of the log files which are still around
+        self.used_fingerprints = set()
+
+    def get_segment_name(self, fingerprint):
+        return hashlib.sha1(self.maps_signature + fingerprint).hexdigest() + self.suffix
+
+    def get_segment_path(self, fingerprint):
+        return os.path.join(self.path, self.get_segment_name(fingerprint))
+
+    def open_segment(self, fingerprint):
+        segment_path = self.get_segment_path(fingerprint)
+        if not os.path.exists(segment_path):
+            return None
+
+        try:
+            return ActionSegment(segment_path)
+        except (ValueError, struct.error):
             return None
 
+    def save_segment(self, fingerprint, segment_writer, offset):
+        if len(segment_writer.names_codes) > ActionSegment.max_names:
+            return
+
+        segment_path = self.get_segment_path(fingerprint)
+        tmp_path = segment_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                segment_writer.write(f, offset)
+        except struct.error:
+            # Player ids which don't fit in the columns, this file will stay uncached
+            os.remove(tmp_path)
+            return
+        os.rename(tmp_path, segment_path)
+
+    def remove_unused_segments(self):
+        '''Segments of log files which were deleted, or resolved with old id maps'''
+        used_segments = set(self.get_segment_name(fingerprint) for fingerprint in self.used_fingerprints)
+        for name in os.listdir(self.path):
+            if name.endswith(self.suffix) and name not in used_segments:
+                os.remove(os.path.join(self.path, name))
+
+
+class HyperLogLog(object):
+    '''Approximate number of distinct values, with a standard error of
+    1.04 / sqrt(2 ** precision). The registers are only allocated once enough
+    values have been seen, small counts staying in a dict (sparse mode), so that
+    many small sketches are cheap. Sketches of the same precision can be merged.'''
+
+    __slots__ = ('precision', 'sparse', 'registers')
+
+    # 2 ** -rank, for each possible rank of a 64 bits hash
+    inverse_powers = [2.0 ** -rank for rank in xrange(66)]
+
+    def __init__(self, precision):
+        self.precision = precision
+        # Register index => rank, until the registers are allocated
+        self.sparse = {}
+        self.registers = None
+
+    @staticmethod
+    def get_precision(error):
+        '''Smallest precision whose standard error is below error'''
+        precision = 4
+        while precision < 16 and 1.04 / math.sqrt(1 << precision) > error:
+            precision += 1
+        return precision
+
+    def __getstate__(self):
+        return (self.precision, self.sparse, self.registers)
+
+    def __setstate__(self, state):
+        self.precision, self.sparse, self.registers = state
+
+    def add(self, value):
+        hash_nb = struct.unpack('<Q', hashlib.md5(str(value)).digest()[:8])[0]
+        nb_bits = 64 - self.precision
+        rest = hash_nb & ((1 << nb_bits) - 1)
+        # Position of the first 1 bit after the index bits
+        self.add_rank(hash_nb >> nb_bits, nb_bits - rest.bit_length() + 1)
+
+    def add_rank(self, index, rank):
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            # A dict entry takes more than 8 bytes
+            if len(self.sparse) > (1 << self.precision) / 8:
+                self.registers = bytearray(1 << self.precision)
+                for index, rank in self.sparse.iteritems():
+                    self.registers[index] = rank
+                self.sparse = None
+
+    def update(self, values):
+        '''Merges another sketch, or adds the values of an iterable, like set.update()'''
+        if not isinstance(values, HyperLogLog):
+            for value in values:
+                self.add(value)
+            return
+
+        if values.precision != self.precision:
+            raise ValueError('Cannot merge sketches of precisions %s and %s' % (self.precision, values.precision))
+        if values.registers is None:
+            ranks = values.sparse.iteritems()
+        else:
+            ranks = ((index, rank) for index, rank in enumerate(values.registers) if rank)
+        for index, rank in ranks:
+            self.add_rank(index, rank)
+
+    def __len__(self):
+        nb_registers = 1 << self.precision
+        if self.registers is None:
+            nb_zeros = nb_registers - len(self.sparse)
+            total = nb_zeros + sum(self.inverse_powers[rank] for rank in self.sparse.itervalues())
+        else:
+            nb_zeros = self.registers.count(b'\x00')
+            total = sum(self.inverse_powers[rank] for rank in self.registers)
+
+        if nb_registers >= 128:
+            alpha = 0.7213 / (1 + 1.079 / nb_registers)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[nb_registers]
+        estimate = alpha * nb_registers * nb_registers / total
+
+        # Linear counting is more accurate for the small counts
+        if estimate <= 2.5 * nb_registers and nb_zeros > 0:
+            estimate = nb_registers * math.log(float(nb_registers) / nb_zeros)
+        return int(round(estimate))
+
 
 class Cohort(TimeSliced):
 
     def __init__(self, cohort_set, start_date):
         self.cohort_set = cohort_set
         self.start_date = start_date
-        self.end_date = self.cohort_set.end_date
+        self.period = cohort_set.period
 
         self.weekly_actives = {}
 
-    def record_action(self, action):
-        # Not in current cohort
-        if action.date < self.start_date:
-            return False
-
-        week_nb = self.get_week_nb_from_date(action.date)
-
-        if week_nb == 0 or self.is_player_from_cohort(action.player_id):
-            self.record_weekly_active(week_nb, action.player_id)
-            return True
-        else:
-            return False
-
-    def is_player_from_cohort(self, player_id):
-        if self.start_date not in self.weekly_actives:
-            return False
-        else:
-            return player_id in self.weekly_actives[self.start_date]
+    @property
+    def end_date(self):
+        return self.cohort_set.end_date
 
     def record_weekly_active(self, week_nb, player_id):
         week_date = self.get_date_from_week_nb(week_nb)
         if week_date not in self.weekly_actives:
-            self.weekly_actives[week_date] = [player_id]
-        elif player_id not in self.weekly_actives[week_date]:
-            self.weekly_actives[week_date].append(player_id)
+            self.weekly_actives[week_date] = new_players_set(self.cohort_set.precision)
+        self.weekly_actives[week_date].add(player_id)
+
+    def count_weekly_active(self, week_nb, nb_players=1):
+        '''When the players are told apart elsewhere - by the CohortSet to bound the
+        memory, or by a DailyRollup'''
+        week_date = self.get_date_from_week_nb(week_nb)
+        self.weekly_actives[week_date] = self.weekly_actives.get(week_date, 0) + nb_players
+
+    def get_nb_actives(self, week_date):
+        if week_date not in self.weekly_actives:
+            return 0
+        elif isinstance(self.weekly_actives[week_date], int):
+            return self.weekly_actives[week_date]
+        else:
+            return len(self.weekly_actives[week_date])
 
     def get_weekly_actives(self):
         weekly_actives = []
         for week_nb, week_date in self.iter_weeks():
-            if week_date in self.weekly_actives:
-                nb_active_players = len(self.weekly_actives[week_date])
-            else:
-                nb_active_players = 0
-            weekly_actives.append([week_nb, nb_active_players])
+            weekly_actives.append([week_nb, self.get_nb_actives(week_date)])
 
         return {'label': self.get_start_date_label(), 'data': weekly_actives}
 
@@ -233,7 +1724,10 @@ class Cohort(TimeSliced):
         i = 0
         for nb_actives in weekly_actives[1:]:
             i += 1
-            percent = round(nb_actives * 100.0 / weekly_actives[0], 1)
+            if weekly_actives[0] == 0: # Period without new players, eg with daily cohorts
+                percent = 0
+            else:
+                percent = round(nb_actives * 100.0 / weekly_actives[0], 1)
             weekly_actives_percent.append([i, percent])
 
         return {'label': self.get_start_date_label(), 'data': weekly_actives_percent}
@@ -241,27 +1735,122 @@ class Cohort(TimeSliced):
 
 class CohortSet(TimeSliced):
 
-    def __init__(self, action_set):
+    def __init__(self, action_set, precision=None, period='week', spill=False):
         self.action_set = action_set
         self.start_date = self.action_set.start_date
-        self.end_date = self.action_set.end_date
+        if period not in self.periods:
+            raise ValueError('Unknown period %s, should be one of: %s' % (period, ', '.join(self.periods)))
+        if period == 'month' and self.start_date.day > 28:
+            raise ValueError('Monthly cohorts must start on one of the first 28 days of a month')
+        self.period = period
+        # HyperLogLog precision of the weekly actives, None to count them exactly - as they are
+        # when spilling, from the players map
+        self.precision = None if spill else precision
+        self.checkpoint_key = (self.precision, spill)
+
+        self.cohorts = []
+        # Player id => week number of their cohort, ie of their first action
+        self.players_cohort_nb = {}
+
+        # To bound the memory, the cohorts only count their weekly actives, and each player
+        # has the number of their cohort and the bitmap of their weeks in it, packed in an
+        # int, in a map which can be spilled
+        if spill:
+            self.players_weeks = new_players_map(spill)
+            self.record_action = self.record_action_counted
+        else:
+            self.players_weeks = None
+
+    @property
+    def end_date(self):
+        return self.action_set.end_date
+
+    def add_cohorts_until(self, week_nb):
+        '''Cohorts are created as the weeks show up in the logs'''
+        while len(self.cohorts) <= week_nb:
+            cohort_date = self.get_date_from_week_nb(len(self.cohorts))
+            self.cohorts.append(Cohort(self, cohort_date))
+
+    def get_state(self):
+        return {'weekly_actives': [cohort.weekly_actives for cohort in self.cohorts],
+                'players_cohort_nb': self.players_cohort_nb,
+                'players_weeks': self.players_weeks}
+
+    def set_state(self, state):
+        self.cohorts = []
+        for weekly_actives in state['weekly_actives']:
+            self.add_cohorts_until(len(self.cohorts))
+            self.cohorts[-1].weekly_actives = weekly_actives
+        self.players_cohort_nb = state['players_cohort_nb']
+        self.players_weeks = state['players_weeks']
+
+    def get_partial(self):
+        # Always exact, as merging needs the player ids to put them back in their cohort -
+        # counted in the players map, which can be spilled, when this one is
+        return CohortSet(self.action_set, period=self.period, spill=self.players_weeks is not None)
+
+    def merge_state(self, state):
+        '''The players of the merged state who were already seen here stay in their cohort'''
+
+        if state['players_weeks'] is not None:
+            for player_id, player in state['players_weeks'].iteritems():
+                cohort_nb = player & 0xFFFF
+                weeks = player >> 16
+                self.add_cohorts_until(cohort_nb + weeks.bit_length() - 1)
+                while weeks:
+                    week_bit = weeks & -weeks
+                    weeks ^= week_bit
+                    self.count_weekly_active(player_id, cohort_nb, cohort_nb + week_bit.bit_length() - 1)
+            return
+
+        for cohort_nb, weekly_actives in enumerate(state['weekly_actives']):
+            for week_date, player_ids in weekly_actives.iteritems():
+                week_nb = self.get_week_nb_from_date(week_date)
+                self.add_cohorts_until(week_nb)
+
+                if self.players_weeks is not None:
+                    for player_id in player_ids:
+                        self.count_weekly_active(player_id, cohort_nb, week_nb)
+                    continue
 
-        self.cohorts = self.get_empty_cohorts()
-        self.populate_cohorts()
+                for player_id in player_ids:
+                    player_cohort_nb = self.players_cohort_nb.get(player_id)
+                    if player_cohort_nb is None or player_cohort_nb > cohort_nb:
+                        player_cohort_nb = cohort_nb
+                        self.players_cohort_nb[player_id] = cohort_nb
+                    self.cohorts[player_cohort_nb].record_weekly_active(week_nb - player_cohort_nb, player_id)
 
-    def get_empty_cohorts(self):
-        cohorts = []
-        for week_nb, week_date in self.iter_weeks():
-            cur_cohort = Cohort(self, week_date)
-            cohorts.append(cur_cohort)
+    def record_action(self, action):
+        week_nb = self.get_week_nb_from_date(action.date)
+        self.add_cohorts_until(week_nb)
 
-        return cohorts
+        # An action older than the player's cohort (logs out of order) makes
+        # them join the earlier cohort from then on
+        cohort_nb = self.players_cohort_nb.get(action.player_id)
+        if cohort_nb is None or cohort_nb > week_nb:
+            cohort_nb = week_nb
+            self.players_cohort_nb[action.player_id] = cohort_nb
 
-    def populate_cohorts(self):
-        for action in self.action_set.iter_actions():
-            for cur_cohort in self.cohorts:
-                if cur_cohort.record_action(action):
-                    break
+        self.cohorts[cohort_nb].record_weekly_active(week_nb - cohort_nb, action.player_id)
+
+    def record_action_counted(self, action):
+        week_nb = self.get_week_nb_from_date(action.date)
+        self.add_cohorts_until(week_nb)
+        self.count_weekly_active(action.player_id, week_nb, week_nb)
+
+    def count_weekly_active(self, player_id, cohort_nb, week_nb):
+        '''Counts the player in the weekly actives of their cohort, or of cohort_nb when
+        it is older, the first time they are seen on the week'''
+
+        player = self.players_weeks.get(player_id)
+        if player is None or player & 0xFFFF > cohort_nb:
+            player = cohort_nb
+        cohort_nb = player & 0xFFFF
+
+        week_bit = 1 << (week_nb - cohort_nb + 16)
+        if not player & week_bit:
+            self.players_weeks[player_id] = player | week_bit
+            self.cohorts[cohort_nb].count_weekly_active(week_nb - cohort_nb)
 
     def get_weekly_actives(self):
         weekly_actives = []
@@ -288,6 +1877,7 @@ class WeeklyPlayerActivity(TimeSliced):
         self.cohort_set = cohort_set
         self.start_date = cohort_set.start_date
         self.end_date = cohort_set.end_date
+        self.period = cohort_set.period
 
         self.weeks = self.get_empty_weeks()
         self.populate_weeks()
@@ -305,7 +1895,7 @@ class WeeklyPlayerActivity(TimeSliced):
                 if week_date not in cur_cohort.weekly_actives:
                     continue
 
-                cur_cohort_cur_week_actives = len(cur_cohort.weekly_actives[week_date])
+                cur_cohort_cur_week_actives = cur_cohort.get_nb_actives(week_date)
                 if cur_cohort.start_date == week_date:
                     self.weeks[week_date]['new_players'] = cur_cohort_cur_week_actives
                 else:
@@ -332,43 +1922,230 @@ class WeeklyPlayerActivity(TimeSliced):
                 {'label': 'Total players', 'data': total_players}]
 
 
-class ConcurrentPlayers(TimeSliced):
+class DateRange(object):
+    '''Dates of the actions, in place of the ActionSet of the objects computed from a DailyRollup'''
 
-    def __init__(self, action_set):
+    def __init__(self, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+
+
+class DailyRollup(object):
+    '''Days on which each player was active, saved to ROLLUP_PATH after each run,
+    for the cohorts to be computed again for another period or start date without
+    reading the logs - see get_cohort_set()'''
+
+    version = 1
+
+    def __init__(self, action_set=None, spill=False):
         self.action_set = action_set
-        self.start_date = self.action_set.end_date - timedelta(days=30)
-        self.end_date = self.action_set.end_date
-
-        self.minutes = self.get_empty_minutes()
-        self.populate_minutes()
-
-    def get_empty_minutes(self):
-        minutes = {}
-        minute_nb = 0
-        while minute_nb < self.minutes_difference(self.start_date, self.end_date) + 1:
-            minutes[minute_nb] = []
-            minute_nb += 1
-        return minutes
-
-    def populate_minutes(self):
-        for action in self.action_set.iter_actions(start_date=self.start_date):
-            minute_nb = self.minutes_difference(self.start_date, action.date)
-            if action.player_id not in self.minutes[minute_nb]:
-                self.minutes[minute_nb].append(action.player_id)
+        # Player id => (ordinal of their first active day, bitmap of their active days from it)
+        self.spill = spill
+        self.players_days = new_players_map(spill)
+        # Date of the last action, when loaded from a file
+        self.saved_end_date = None
+
+    @property
+    def end_date(self):
+        if self.action_set is None:
+            return self.saved_end_date
+        return self.action_set.end_date
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            rollup = cPickle.load(f)
+        if rollup['version'] != cls.version:
+            raise ValueError('%s was saved by another version, run the stats again to update it' % path)
+
+        daily_rollup = cls()
+        daily_rollup.saved_end_date = rollup['end_date']
+        daily_rollup.players_days = rollup['players_days']
+        return daily_rollup
+
+    def save(self, path):
+        rollup = {'version': self.version,
+                  'end_date': self.end_date,
+                  'players_days': self.players_days}
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(rollup, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def get_state(self):
+        return {'players_days': self.players_days}
+
+    def set_state(self, state):
+        self.players_days = restore_players_map(state['players_days'], self.spill)
+
+    def get_partial(self):
+        return DailyRollup(self.action_set, spill=self.spill)
+
+    def merge_state(self, state):
+        for player_id, (first_day, days) in state['players_days'].iteritems():
+            self.add_player_days(player_id, first_day, days)
+
+    def add_player_days(self, player_id, first_day, days):
+        player_days = self.players_days.get(player_id)
+        if player_days is not None:
+            if player_days[0] <= first_day:
+                first_day, days = player_days[0], player_days[1] | (days << (first_day - player_days[0]))
+            else:
+                days |= player_days[1] << (player_days[0] - first_day)
+        self.players_days[player_id] = (first_day, days)
 
-    def get_concurrent_players(self):
-        concurrent_players = []
+    def record_action(self, action):
+        day = action.date.toordinal()
+        player_days = self.players_days.get(action.player_id)
+        if player_days is not None and day >= player_days[0]:
+            day_bit = 1 << (day - player_days[0])
+            if not player_days[1] & day_bit:
+                self.players_days[action.player_id] = (player_days[0], player_days[1] | day_bit)
+        else:
+            self.add_player_days(action.player_id, day, 1)
+
+    def get_cohort_set(self, start_date, period='week'):
+        '''The cohorts of the players from start_date on, one per period ('day', 'week'
+        or 'month'), as a CohortSet which can be used like the one of the logs - with
+        the days as the smallest unit, so start_date should be at midnight
+
+        The cohorts only count their weekly actives, computed once for all the players
+        who were active on the same days.'''
+
+        cohort_set = CohortSet(DateRange(start_date, self.end_date), period=period)
+        start_day = start_date.toordinal()
+        if self.end_date is None:
+            return cohort_set
+
+        # Period number of each day, from start_date to the end date
+        days_periods_nbs = [cohort_set.get_week_nb_from_date(start_date + timedelta(days=day_nb))
+                            for day_nb in xrange(self.end_date.toordinal() - start_day + 1)]
+
+        # (first active day, bitmap of the active days) => number of players
+        players_days_counts = {}
+        for player_id, player_days in self.players_days.iteritems():
+            players_days_counts[player_days] = players_days_counts.get(player_days, 0) + 1
+
+        for (first_day, days), nb_players in players_days_counts.iteritems():
+            if first_day < start_day:
+                days >>= start_day - first_day
+                first_day = start_day
+            first_day_nb = first_day - start_day
+
+            periods_nbs = set()
+            while days:
+                day_bit = days & -days
+                days ^= day_bit
+                periods_nbs.add(days_periods_nbs[first_day_nb + day_bit.bit_length() - 1])
+            if not periods_nbs:
+                continue
 
-        for minute_nb, player_ids in self.minutes.iteritems():
-            cur_date = self.start_date + timedelta(minutes=minute_nb)
-            minute_timestamp = int(mktime(cur_date.timetuple()) * 1000)
-            concurrent_players.append([minute_timestamp, len(player_ids)])
+            cohort_nb = min(periods_nbs)
+            cohort_set.add_cohorts_until(max(periods_nbs))
+            for period_nb in periods_nbs:
+                cohort_set.cohorts[cohort_nb].count_weekly_active(period_nb - cohort_nb, nb_players)
 
-        # Chronological order is expected
-        date_key = lambda x: x[0]
-        concurrent_players.sort(key=date_key)
+        return cohort_set
+
+    def get_cohorts_data(self, start_date, period='week'):
+        '''The cohorts datasets of the output, for another period or start date'''
+        cohort_set = self.get_cohort_set(start_date, period)
+        return {'weekly_actives': add_average_to_weekly_set(cohort_set.get_weekly_actives()),
+                'weekly_actives_percent': add_average_to_weekly_set(cohort_set.get_weekly_actives_percent()),
+                'active_players_per_week': WeeklyPlayerActivity(cohort_set).get_active_players_per_week()}
 
-        return concurrent_players
+
+class ConcurrentPlayers(TimeSliced):
+
+    def __init__(self, action_set, window_days=None, resolution=None, enough_players=None, precision=None):
+        self.action_set = action_set
+
+        if window_days is None:
+            window_days = CONCURRENCY_WINDOW_DAYS
+        if resolution is None:
+            resolution = CONCURRENCY_RESOLUTION
+        if enough_players is None:
+            enough_players = ENOUGH_PLAYERS
+        if 3600 % resolution != 0:
+            raise ValueError('The concurrency resolution must divide an hour: %s' % resolution)
+        self.window_days = window_days
+        self.resolution = resolution # seconds
+        self.enough_players = enough_players
+        # HyperLogLog precision of the buckets, None to count their players exactly
+        self.precision = precision
+        self.checkpoint_key = (self.window_days, self.resolution, self.precision)
+
+        # The end date is only known once all the actions have been read, so the
+        # buckets form a ring preallocated for the whole window, where the newer
+        # buckets take the place of the ones which fell out of the window
+        self.nb_buckets = self.window_days * 24 * 3600 / self.resolution + 1
+        self.buckets_nb = array.array('l', [-1]) * self.nb_buckets
+        self.buckets_players = [None] * self.nb_buckets
+
+    @property
+    def end_date(self):
+        return self.action_set.end_date
+
+    @property
+    def start_date(self):
+        return self.get_date_from_bucket_nb(self.get_first_bucket_nb())
+
+    def get_bucket_nb_from_date(self, date):
+        return self.seconds_difference(self.action_set.start_date, date) / self.resolution
+
+    def get_date_from_bucket_nb(self, bucket_nb):
+        return self.action_set.start_date + timedelta(seconds=self.resolution) * bucket_nb
+
+    def get_first_bucket_nb(self):
+        return self.get_bucket_nb_from_date(self.end_date) - self.nb_buckets + 1
+
+    def get_state(self):
+        return {'buckets_nb': self.buckets_nb,
+                'buckets_players': self.buckets_players}
+
+    def set_state(self, state):
+        self.buckets_nb = state['buckets_nb']
+        self.buckets_players = state['buckets_players']
+
+    def get_partial(self):
+        return ConcurrentPlayers(self.action_set, self.window_days, self.resolution, self.enough_players,
+                                 self.precision)
+
+    def merge_state(self, state):
+        for slot_nb, bucket_nb in enumerate(state['buckets_nb']):
+            if bucket_nb < 0 or self.buckets_nb[slot_nb] > bucket_nb:
+                continue
+            elif self.buckets_nb[slot_nb] < bucket_nb:
+                self.buckets_nb[slot_nb] = bucket_nb
+                self.buckets_players[slot_nb] = new_players_set(self.precision)
+            self.buckets_players[slot_nb].update(state['buckets_players'][slot_nb])
+
+    def record_action(self, action):
+        bucket_nb = self.get_bucket_nb_from_date(action.date)
+        slot_nb = bucket_nb % self.nb_buckets
+
+        if self.buckets_nb[slot_nb] != bucket_nb:
+            if self.buckets_nb[slot_nb] > bucket_nb:
+                return # Already out of the window
+            self.buckets_nb[slot_nb] = bucket_nb
+            self.buckets_players[slot_nb] = new_players_set(self.precision)
+
+        self.buckets_players[slot_nb].add(action.player_id)
+
+    def get_counts(self):
+        '''Number of players in each bucket of the window, in chronological order'''
+        counts = array.array('l', [0]) * self.nb_buckets
+        first_bucket_nb = self.get_first_bucket_nb()
+        for slot_nb, bucket_nb in enumerate(self.buckets_nb):
+            # The window can start before the logs, and some slots may be unused
+            if bucket_nb >= 0 and bucket_nb >= first_bucket_nb:
+                counts[bucket_nb - first_bucket_nb] = len(self.buckets_players[slot_nb])
+        return counts
+
+    def get_concurrent_players(self):
+        timestamps = self.get_timestamps(self.start_date, self.resolution, self.nb_buckets)
+        return [[timestamp, count] for timestamp, count in zip(timestamps, self.get_counts())]
 
     def get_concurrent_players_trimmed(self):
         concurrent_players = self.get_concurrent_players()
@@ -384,130 +2161,386 @@ class ConcurrentPlayers(TimeSliced):
 
         return [{'label': 'Concurrent players', 'data': trimmed_concurrent_players}]
 
-    def get_time_percent_with_enough_players(self):
+    def get_time_percent_with_enough_players(self, period=3600):
+        '''Rolled up per hour by default, or per day with period=24*3600'''
+
         time_percent_enough = []
         time_percent_not_enough = []
-        time_percent_empty = []
-        concurrent_players = self.get_concurrent_players()
-        minute_nb = 0
-
-        for i in xrange(self.hours_difference(self.start_date, self.end_date)):
-            nb_times_enough = 0
-            nb_times_nobody = 0
-            for j in xrange(60):
-                if concurrent_players[minute_nb][1] >= 3:
-                    nb_times_enough += 1
-                elif concurrent_players[minute_nb][1] == 0:
-                    nb_times_nobody += 1
-                minute_nb += 1
-
-            percent_enough = round(nb_times_enough * 100 / 60, 1)
-            percent_not_enough = round((60.0 - nb_times_enough) * 100 / 60, 1)
-            percent_empty = round((60.0 - nb_times_nobody) * 100 / 60, 1)
-
-            cur_date = self.start_date + timedelta(hours=1) * i
-            cur_timestamp = int(mktime(cur_date.timetuple()) * 1000)
+
+        buckets_per_period = period / self.resolution
+        nb_periods = (self.nb_buckets - 1) / buckets_per_period
+        enough = [count >= self.enough_players for count in self.get_counts()]
+        timestamps = self.get_timestamps(self.start_date, period, nb_periods)
+
+        for period_nb, cur_timestamp in enumerate(timestamps):
+            first_bucket = period_nb * buckets_per_period
+            nb_times_enough = sum(enough[first_bucket:first_bucket + buckets_per_period])
+
+            percent_enough = round(nb_times_enough * 100 / buckets_per_period, 1)
+            percent_not_enough = round((buckets_per_period - nb_times_enough) * 100.0 / buckets_per_period, 1)
+
             time_percent_enough.append([cur_timestamp, percent_enough])
             time_percent_not_enough.append([cur_timestamp, percent_not_enough])
-            time_percent_empty.append([cur_timestamp, percent_empty])
 
         return [{'label': 'Percentage of time with enough players', 'data': time_percent_enough},
                 {'label': 'Percentage of time with NOT enough players', 'data': time_percent_not_enough}]
 
 
+class OwaFetcher(object):
+    '''Daily rows of the OWA API - past days never change, so they are cached on
+    disk, and only the missing and recent days are fetched, in a background thread'''
+
+    date_format = '%Y%m%d'
+
+    def __init__(self, start_date, url=None, cache_path=None, timeout=None):
+        self.start_date = start_date
+        self.url = url or OWA_URL
+        self.cache_path = cache_path or OWA_CACHE_PATH
+        self.timeout = timeout or OWA_TIMEOUT
+
+        # Day => OWA row, or None when OWA had no row for that day
+        self.days = self.load_cache()
+        self.fetched_days = None
+        self.error = None
+        self.thread = None
+        self.start_time = None
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def save_cache(self):
+        if not self.cache_path:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.days, f)
+        os.rename(tmp_path, self.cache_path)
+
+    def iter_days(self, start_date, end_date):
+        cur_date = start_date
+        while cur_date.date() <= end_date.date():
+            yield cur_date.strftime(self.date_format)
+            cur_date += timedelta(days=1)
+
+    def get_first_day_to_fetch(self, today):
+        refresh_date = today - timedelta(days=OWA_REFRESH_DAYS)
+        for day in self.iter_days(self.start_date, today):
+            if day not in self.days or day >= refresh_date.strftime(self.date_format):
+                return day
+        return None
+
+    def start(self):
+        '''Can be called again once a fetch is over, to refresh the recent days'''
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.fetched_days = None
+        self.error = None
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.fetch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fetch(self):
+        try:
+            today = datetime.now()
+            start_date_str = self.get_first_day_to_fetch(today)
+            if start_date_str is None or not self.url:
+                return
+            end_date_str = today.strftime(self.date_format)
+            owa_url = '%s/api.php?owa_apiKey=%s&owa_do=getResultSet&owa_metrics=bounces,repeatVisitors,newVisitors,visits&owa_dimensions=date&owa_startDate=%s&owa_endDate=%s&owa_siteId=%s&owa_format=json' % \
+                                (self.url, OWA_API_KEY, start_date_str, end_date_str, OWA_SITE_ID)
+
+            r = requests.get(owa_url, timeout=self.timeout)
+            r.raise_for_status()
+
+            fetched_days = {}
+            for day in self.iter_days(datetime.strptime(start_date_str, self.date_format), today):
+                fetched_days[day] = None
+            for row in json.loads(r.content)['rows']:
+                fetched_days[row['date']] = row
+            self.fetched_days = fetched_days
+        except Exception as e:
+            self.error = e
+
+    def get_rows(self, start_date, end_date, wait=True):
+        '''Without waiting, the days which are being fetched are only used once
+        the fetch is over, on a later call'''
+
+        if self.thread is None:
+            self.start()
+        self.thread.join(self.timeout if wait else 0)
+
+        if self.thread.is_alive():
+            if wait:
+                logger.warning('OWA did not answer within %s seconds, using the cached days only', self.timeout)
+        elif self.error is not None:
+            logger.warning('Could not fetch the OWA data, using the cached days only: %s', self.error)
+            self.error = None
+        elif self.fetched_days:
+            self.days.update(self.fetched_days)
+            self.fetched_days = None
+            self.save_cache()
+
+        rows = []
+        for day in self.iter_days(start_date, end_date):
+            if self.days.get(day):
+                rows.append(self.days[day])
+        return rows
+
+
+class FunnelTable(object):
+    '''Transitions between the steps of a funnel, compiled from its definition -
+    see Funnel.definitions. The steps are designated by their number, their code.'''
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps_names = [step_name for step_name, condition in steps]
+        self.first_action_code = None
+        # Step code => {action name: next step code}
+        self.actions_transitions = [{} for step in steps]
+        # Step code => (seconds since the first action, next step code), or None
+        self.time_transitions = [None] * len(steps)
+
+        for code, (step_name, condition) in enumerate(steps):
+            if condition == 'owa':
+                continue
+            elif condition == 'first_action':
+                self.first_action_code = code
+            elif code == 0 or self.first_action_code is None:
+                raise ValueError('The step %s of the funnel %s comes before its first_action step' % (step_name, name))
+            elif isinstance(condition, dict):
+                self.time_transitions[code - 1] = (condition['min_hours'] * 3600, code)
+            else:
+                for action_name in condition:
+                    self.actions_transitions[code - 1][action_name] = code
+        if self.first_action_code is None:
+            raise ValueError('The funnel %s has no first_action step' % name)
+
+        # Only these actions make players move through the steps - the others only
+        # matter for the time elapsed since their first action
+        self.actions_names = set()
+        for transitions in self.actions_transitions:
+            self.actions_names.update(transitions)
+
+        # Of each run of actions which aren't in actions_names, only the last one needs to be
+        # kept for a later replay: they can only meet a time condition, which any later action
+        # meets too. Only when the time condition is the one of the last step, as reaching its
+        # step earlier could otherwise let the following actions move the player further.
+        self.compact_events = all(transition is None for transition in self.time_transitions[:-2])
+
+
 class Funnel(TimeSliced):
 
-    def __init__(self, action_set):
+    # Funnel name => its steps, in order, each with the condition for the players to reach it
+    # from the previous one: a tuple of actions names, {'min_hours': n} for any action at least
+    # n full hours after their first one, 'first_action' for the step they start at, or 'owa'
+    # for the first steps, only counted by OWA. Several funnels are followed in the same pass,
+    # the first one being the funnel dataset.
+    definitions = OrderedDict([('funnel', [('first_visit', 'owa'),
+                                           ('registration', 'owa'),
+                                           ('game_loaded', 'first_action'),
+                                           ('first_game_created', ('create',)),
+                                           ('game_voting', ('voting',)),
+                                           ('game_complete', ('complete',)),
+                                           ('second_game', ('create', 'join')),
+                                           ('second_day', {'min_hours': 16})])])
+
+    def __init__(self, action_set, keep_events=False, definitions=None, spill=False):
         self.action_set = action_set
 
         self.start_date = self.action_set.start_date
-        self.end_date = self.action_set.end_date
-
-        self.steps_names = ['first_visit',
-                            'registration',
-                            'game_loaded',
-                            'first_game_created',
-                            'game_voting',
-                            'game_complete',
-                            'second_game',
-                            'second_day']
-        self.steps = self.get_empty_steps()
-
-        self.owa_data = self.get_owa_data()
+
+        if definitions is not None:
+            self.definitions = definitions
+        self.tables = [FunnelTable(name, steps) for name, steps in self.definitions.iteritems()]
+        self.steps_names = self.tables[0].steps_names
+        self.steps_actions_names = set()
+        for table in self.tables:
+            self.steps_actions_names.update(table.actions_names)
+        self.compact_events = all(table.compact_events for table in self.tables)
+        self.spill = spill
+        self.checkpoint_key = self.definitions.items()
+
+        # Funnel name => week number => step name => number of players of the week who reached it
+        self.steps = dict((table.name, {}) for table in self.tables)
+        # Player id => their state, packed in an int: the seconds between the start date and
+        # their first action, followed by the code of the step they reached in each funnel,
+        # codes_bits bits for all of them
+        self.players = new_players_map(spill)
+        self.codes_bits = 8 * len(self.tables)
+
+        self.owa_fetcher = None
+        self.owa_data = None
+        # Week number => first_visit and registration steps, from the OWA data
+        self.owa_steps = {}
+
+        # When processing a part of the logs in parallel, the actions of each player are
+        # only kept, to be replayed in order after the state of the previous parts
+        if keep_events:
+            self.players_events = new_players_map(spill)
+        else:
+            self.players_events = None
+
+    @property
+    def end_date(self):
+        return self.action_set.end_date
+
+    def get_week_steps(self, week_nb, table=None):
+        if table is None:
+            table = self.tables[0]
+        steps = self.steps[table.name]
+        if week_nb not in steps:
+            steps[week_nb] = {}
+            for step_name in table.steps_names:
+                steps[week_nb][step_name] = 0
+
+        return steps[week_nb]
+
+    def start_owa_fetch(self):
+        '''Fetches the OWA data in the background, while the actions are processed'''
+        if self.owa_fetcher is None:
+            self.owa_fetcher = OwaFetcher(self.start_date)
+        self.owa_fetcher.start()
+
+    def load_owa_data(self, wait=True):
+        '''Needs the end date, so must be called once the actions have been processed.
+        Can be called again, to use the days fetched since.'''
+        self.owa_data = self.get_owa_data(wait=wait)
         self.process_owa_data()
 
-        self.process_actions()
+    def get_owa_data(self, wait=True):
+        if self.owa_fetcher is None:
+            self.owa_fetcher = OwaFetcher(self.start_date)
+        return {'rows': self.owa_fetcher.get_rows(self.start_date, self.end_date, wait=wait)}
 
-    def get_empty_steps(self):
-        steps = {}
-        for step_name in self.steps_names:
-            for week_nb, week_date in self.iter_weeks():
-                if week_nb in steps:
-                    steps[week_nb][step_name] = 0
+    def process_owa_data(self):
+        # Kept apart from the steps of the actions, which are the ones saved in checkpoints
+        self.owa_steps = {}
+        for row in self.owa_data['rows']:
+            cur_date = datetime.strptime(row['date'], '%Y%m%d')
+            week_nb = self.get_week_nb_from_date(cur_date)
+            if week_nb not in self.owa_steps:
+                self.owa_steps[week_nb] = {'first_visit': 0, 'registration': 0}
+            self.owa_steps[week_nb]['first_visit'] += int(row['newVisitors'])
+            self.owa_steps[week_nb]['registration'] += int(row['newVisitors']) - int(row['bounces'])
+
+    def get_state(self):
+        if self.players_events is not None:
+            return {'players_events': self.players_events}
+
+        # The OWA data isn't part of it, it is loaded again on each run
+        return {'steps': self.steps,
+                'players': self.players}
+
+    def set_state(self, state):
+        self.steps = state['steps']
+        self.players = restore_players_map(state['players'], self.spill)
+
+    def get_partial(self):
+        return Funnel(self.action_set, keep_events=True, definitions=self.definitions, spill=self.spill)
+
+    def merge_state(self, state):
+        for player_id, events in state['players_events'].iteritems():
+            for name, date in events:
+                if self.players_events is None:
+                    self.record_player_action(player_id, name, date)
                 else:
-                    steps[week_nb] = {step_name: 0}
+                    self.record_player_event(player_id, name, date)
 
-        return steps
+    def merge_overlapping_states(self, states):
+        '''Merges the states of parts of the logs which can cover the same days, from
+        several nodes: the actions of each player are replayed in chronological order
 
-    def get_owa_data(self):
-        start_date_str = self.start_date.strftime('%Y%m%d')
-        end_date_str = self.end_date.strftime('%Y%m%d')
-        owa_url = '%s/api.php?owa_apiKey=%s&owa_do=getResultSet&owa_metrics=bounces,repeatVisitors,newVisitors,visits&owa_dimensions=date&owa_startDate=%s&owa_endDate=%s&owa_siteId=%s&owa_format=json' % \
-                            (OWA_URL, OWA_API_KEY, start_date_str, end_date_str, OWA_SITE_ID)
+        See record_player_event() for the actions which are dropped from the states.'''
 
-        r = requests.get(owa_url)
-        return json.loads(r.content)
+        players_events = new_players_map(self.spill)
+        for state in states:
+            for player_id, events in state['players_events'].iteritems():
+                player_events = players_events.get(player_id)
+                if player_events is not None:
+                    player_events.extend(events)
+                else:
+                    players_events[player_id] = list(events)
+
+        date_key = lambda event: event[1]
+        for player_id, events in players_events.iteritems():
+            events.sort(key=date_key)
+            for name, date in events:
+                self.record_player_action(player_id, name, date)
+
+    def record_action(self, action):
+        if self.players_events is None:
+            self.record_player_action(action.player_id, action.name, action.date)
+        else:
+            self.record_player_event(action.player_id, action.name, action.date)
+
+    def record_player_event(self, player_id, name, date):
+        if name not in self.steps_actions_names:
+            name = None
+
+        events = self.players_events.get(player_id)
+        if events is None:
+            self.players_events[player_id] = [(name, date)]
+        elif name is None and self.compact_events and len(events) > 1 and events[-1][0] is None:
+            # Out of consecutive other actions, only the last one can matter
+            events[-1] = (name, date)
+        else:
+            events.append((name, date))
+
+    def record_player_action(self, player_id, name, date):
+        player = self.players.get(player_id)
+        second_nb = None
+
+        if player is None:
+            second_nb = self.seconds_difference(self.start_date, date)
+            player = second_nb << self.codes_bits
+            week_nb = self.get_week_nb_from_date(date)
+            for table_nb, table in enumerate(self.tables):
+                player |= table.first_action_code << (8 * table_nb)
+                self.get_week_steps(week_nb, table)[table.steps_names[table.first_action_code]] += 1
+            self.players[player_id] = player
+
+        for table_nb, table in enumerate(self.tables):
+            code = (player >> (8 * table_nb)) & 0xFF
+            next_code = table.actions_transitions[code].get(name)
+            if next_code is None:
+                time_transition = table.time_transitions[code]
+                if time_transition is None:
+                    continue
+                if second_nb is None:
+                    second_nb = self.seconds_difference(self.start_date, date)
+                if second_nb - (player >> self.codes_bits) < time_transition[0]:
+                    continue
+                next_code = time_transition[1]
+
+            player += (next_code - code) << (8 * table_nb)
+            self.players[player_id] = player
+            # The players are counted in the week of their first action
+            week_nb = (player >> self.codes_bits) / (7 * 24 * 3600)
+            self.steps[table.name][week_nb][table.steps_names[next_code]] += 1
+
+    def get_weekly_steps_percent(self, funnel_name=None):
+        '''Of the first funnel by default'''
+
+        if funnel_name is None:
+            table = self.tables[0]
+        else:
+            table = dict((table.name, table) for table in self.tables)[funnel_name]
+        steps_names = table.steps_names
 
-    def process_owa_data(self):
-        for row in self.owa_data['rows']:
-            cur_date = datetime.strptime(row['date'], '%Y%m%d')
-            week_nb = self.get_week_nb_from_date(cur_date)
-            self.steps[week_nb]['first_visit'] += int(row['newVisitors'])
-            self.steps[week_nb]['registration'] += int(row['newVisitors']) - int(row['bounces'])
-
-    def process_actions(self):
-        player_status = {}
-        for action in self.action_set.iter_actions():
-            player_id = action.player_id
-            action_week_nb = self.get_week_nb_from_date(action.date)
-
-            if player_id not in player_status:
-                player_status[player_id] = {'week_nb': action_week_nb,
-                                            'first_action_date': action.date,
-                                            'step': 'game_loaded'}
-                self.steps[action_week_nb]['game_loaded'] += 1
-
-            player_week_nb = player_status[player_id]['week_nb']
-
-            if action.name == 'create' and player_status[player_id]['step'] == "game_loaded":
-                player_status[player_id]['step'] = 'first_game_created'
-                self.steps[player_week_nb]['first_game_created'] += 1
-
-            elif action.name == 'voting' and player_status[player_id]['step'] == "first_game_created":
-                player_status[player_id]['step'] = 'game_voting'
-                self.steps[player_week_nb]['game_voting'] += 1
-
-            elif action.name == 'complete' and player_status[player_id]['step'] == "game_voting":
-                player_status[player_id]['step'] = 'game_complete'
-                self.steps[player_week_nb]['game_complete'] += 1
-
-            elif (action.name == 'create' or action.name == 'join') and \
-                        player_status[player_id]['step'] == "game_complete":
-                player_status[player_id]['step'] = 'second_game'
-                self.steps[player_week_nb]['second_game'] += 1
-
-            elif self.hours_difference(player_status[player_id]['first_action_date'], action.date) > 15 and \
-                        player_status[player_id]['step'] == "second_game":
-                player_status[player_id]['step'] = 'second_day'
-                self.steps[player_week_nb]['second_day'] += 1
-
-    def get_weekly_steps_percent(self):
         weekly_step_list = []
         for week_nb, week_date in self.iter_weeks():
+            week_steps = dict(self.get_week_steps(week_nb, table))
+            for step_name, step_nb in self.owa_steps.get(week_nb, {}).iteritems():
+                if step_name in week_steps:
+                    week_steps[step_name] += step_nb
             week_step = {'label': week_date.isoformat()[:10], 'data': []}
-            for step_nb in xrange(1, len(self.steps_names)):
-                cur_step_nb = self.steps[week_nb][self.steps_names[step_nb]]
-                prev_step_nb = self.steps[week_nb][self.steps_names[step_nb - 1]]
+            for step_nb in xrange(1, len(steps_names)):
+                cur_step_nb = week_steps[steps_names[step_nb]]
+                prev_step_nb = week_steps[steps_names[step_nb - 1]]
 
                 if prev_step_nb == 0:
                     step_percent = 0
@@ -519,43 +2552,519 @@ class Funnel(TimeSliced):
                 week_step['data'].append([step_nb, step_percent])
 
             # Total - ie proportion of new visitors who go through all the steps
-            total_percent = self.steps[week_nb][self.steps_names[step_nb]] * 100.0 / \
-                            self.steps[week_nb][self.steps_names[0]]
+            if week_steps[steps_names[0]] == 0: # No OWA data for this week
+                total_percent = 0
+            else:
+                total_percent = week_steps[steps_names[step_nb]] * 100.0 / \
+                                week_steps[steps_names[0]]
             week_step['data'].append([step_nb + 1, round(total_percent, 2)])
 
             weekly_step_list.append(week_step)
 
         return weekly_step_list
 
+class Stats(object):
+    '''The output datasets, computed from the objects they depend on - only those
+    needed by the requested datasets are built, and the logs are only read as far
+    back as they need. Used as a library:
+
+        load_settings()
+        stats = Stats(start_date, ['concurrent_players'])
+        stats.process_actions()
+        data = stats.get_data()
+
+    With partial, the objects are kept in a state which can be merged with the ones
+    of other nodes, written by save_partial() - see merge_partials().'''
+
+    partial_version = 1
+
+    datasets_names = ('weekly_actives',
+                      'weekly_actives_percent',
+                      'active_players_per_week',
+                      'concurrent_players',
+                      'enough_players_percent',
+                      'funnel')
+
+    # Dataset or object => objects it is computed from, the first one naming its metrics stage
+    dependencies = {'weekly_actives': ['CohortSet'],
+                    'weekly_actives_percent': ['CohortSet'],
+                    'active_players_per_week': ['WeeklyPlayerActivity'],
+                    'concurrent_players': ['ConcurrentPlayers'],
+                    'enough_players_percent': ['ConcurrentPlayers'],
+                    'funnel': ['Funnel', 'OWA'],
+                    'WeeklyPlayerActivity': ['CohortSet'],
+                    'OWA': ['Funnel']}
+
+    def __init__(self, start_date, datasets_names=None, metrics=None, partial=False):
+        if datasets_names is None:
+            datasets_names = self.datasets_names
+        for name in datasets_names:
+            if name not in self.datasets_names:
+                raise ValueError('Unknown dataset %s, should be one of: %s' % (name, ', '.join(self.datasets_names)))
+        self.requested_names = list(datasets_names)
+        self.requirements = self.get_requirements(datasets_names)
+        if ROLLUP_PATH:
+            # Kept up to date whatever the datasets, so it needs all the actions
+            self.requirements.add('DailyRollup')
+        if partial and 'CohortSet' in self.requirements:
+            # The players of the nodes can overlap, so their cohorts are only known once
+            # the active days of all the nodes are merged
+            self.requirements.add('DailyRollup')
+        self.partial = partial
+
+        if metrics is None:
+            metrics = RunMetrics(enabled=False)
+        self.metrics = metrics
+
+        self.action_set = ActionSet(start_date, metrics=metrics)
+        precision = get_approximate_precision()
+        spill = PLAYERS_MEMORY_BUDGET is not None
+        self.concurrent_players = self.build('ConcurrentPlayers', ConcurrentPlayers, precision=precision)
+        if partial:
+            self.cohort_set = None
+        else:
+            self.cohort_set = self.build('CohortSet', CohortSet, precision=precision, spill=spill)
+        self.funnel = self.build('Funnel', Funnel, keep_events=partial, spill=spill)
+        self.daily_rollup = self.build('DailyRollup', DailyRollup, spill=spill)
+        self.consumers = [consumer for consumer in [self.concurrent_players, self.cohort_set, self.funnel,
+                                                    self.daily_rollup]
+                          if consumer is not None]
+        self.week_set = None
+        self.actions_start_date = None
+
+    @classmethod
+    def get_requirements(cls, names):
+        requirements = set()
+        names = list(names)
+        while names:
+            for dependency in cls.dependencies.get(names.pop(), []):
+                if dependency not in requirements:
+                    requirements.add(dependency)
+                    names.append(dependency)
+        return requirements
+
+    def build(self, name, consumer_class, **kwargs):
+        if name not in self.requirements:
+            return None
+        return consumer_class(self.action_set, **kwargs)
+
+    def get_actions_start_date(self):
+        '''The concurrent players only need the last days of actions - the other
+        consumers need all of them'''
+
+        if self.requirements != set(['ConcurrentPlayers']):
+            return None
+        end_date = self.action_set.get_end_date()
+        if end_date is None:
+            return None
+        # With a day of margin, the buckets being aligned on the start date
+        return end_date - timedelta(days=self.concurrent_players.window_days + 1)
+
+    def start_owa_fetch(self):
+        if 'OWA' in self.requirements:
+            self.funnel.start_owa_fetch()
+
+    def refresh_owa_data(self, interval):
+        '''Fetches the OWA data again when the last fetch started more than interval seconds ago'''
+        if 'OWA' in self.requirements and time.time() - self.funnel.owa_fetcher.start_time >= interval:
+            self.funnel.start_owa_fetch()
+
+    def process_actions(self, checkpoint=None, jobs=1):
+        # The partials of the nodes don't include the OWA data, fetched once merged
+        if not self.partial:
+            self.start_owa_fetch()
+        self.actions_start_date = self.get_actions_start_date()
+        self.action_set.process_actions(self.consumers, checkpoint=checkpoint, jobs=jobs,
+                                        start_date=self.actions_start_date)
+        self.save_rollup()
+
+    def process_new_actions(self, checkpoint):
+        self.action_set.process_new_actions(self.consumers, checkpoint=checkpoint, start_date=self.actions_start_date)
+
+    def save_rollup(self):
+        if ROLLUP_PATH and self.daily_rollup is not None:
+            with self.metrics.stage('DailyRollup'):
+                self.daily_rollup.save(ROLLUP_PATH)
+
+    def save_partial(self, path):
+        '''The states of the objects, once the actions of the logs of this node are processed'''
+
+        partial = {'version': self.partial_version,
+                   'start_date': self.action_set.start_date,
+                   'end_date': self.action_set.end_date,
+                   'keys': {},
+                   'states': {}}
+        for consumer in self.consumers:
+            name = consumer.__class__.__name__
+            partial['keys'][name] = getattr(consumer, 'checkpoint_key', None)
+            partial['states'][name] = consumer.get_state()
+
+        with self.metrics.stage('output'):
+            tmp_path = path + '.tmp'
+            with gzip.open(tmp_path, 'wb') as f:
+                cPickle.dump(partial, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, path)
+
+    def merge_partials(self, paths):
+        '''Merges the partials saved by the nodes, instead of processing the actions -
+        they must have been saved with the same settings, and for these datasets'''
+
+        self.start_owa_fetch()
+        funnel_states = []
+
+        with self.metrics.stage('Partials'):
+            for path in paths:
+                with gzip.open(path, 'rb') as f:
+                    partial = cPickle.load(f)
+                if partial['version'] != self.partial_version or \
+                        partial['start_date'] != self.action_set.start_date:
+                    raise ValueError('%s was saved by another version, or for another start date' % path)
+                if self.action_set.end_date is None or \
+                        (partial['end_date'] is not None and partial['end_date'] > self.action_set.end_date):
+                    self.action_set.end_date = partial['end_date']
+
+                for consumer in self.consumers:
+                    name = consumer.__class__.__name__
+                    if name not in partial['states']:
+                        raise ValueError('%s has no %s, it was saved for other datasets' % (path, name))
+                    if partial['keys'][name] != getattr(consumer, 'checkpoint_key', None):
+                        raise ValueError('%s was saved with other settings for %s' % (path, name))
+                    if consumer is self.funnel:
+                        funnel_states.append(partial['states'][name])
+                    else:
+                        consumer.merge_state(partial['states'][name])
+
+        if self.funnel is not None:
+            with self.metrics.stage('Funnel'):
+                self.funnel.players_events = None
+                self.funnel.merge_overlapping_states(funnel_states)
+        if 'CohortSet' in self.requirements:
+            with self.metrics.stage('CohortSet'):
+                self.cohort_set = self.daily_rollup.get_cohort_set(self.action_set.start_date)
+        self.save_rollup()
+
+    def get_data(self, wait_owa=True):
+        '''Without waiting for OWA, its data is only used once fetched'''
+
+        if 'OWA' in self.requirements:
+            with self.metrics.stage('OWA'):
+                self.funnel.load_owa_data(wait=wait_owa)
+        if 'WeeklyPlayerActivity' in self.requirements:
+            with self.metrics.stage('WeeklyPlayerActivity'):
+                self.week_set = WeeklyPlayerActivity(self.cohort_set)
+
+        data = {}
+        for name in self.requested_names:
+            with self.metrics.stage(self.dependencies[name][0]):
+                data[name] = getattr(self, 'get_' + name)()
+
+        return data
+
+    def get_weekly_actives(self):
+        return add_average_to_weekly_set(self.cohort_set.get_weekly_actives())
+
+    def get_weekly_actives_percent(self):
+        return add_average_to_weekly_set(self.cohort_set.get_weekly_actives_percent())
+
+    def get_active_players_per_week(self):
+        return self.week_set.get_active_players_per_week()
+
+    def get_concurrent_players(self):
+        return self.concurrent_players.get_concurrent_players_trimmed()
+
+    def get_enough_players_percent(self):
+        return self.concurrent_players.get_time_percent_with_enough_players()
+
+    def get_funnel(self):
+        return add_average_to_weekly_set(self.funnel.get_weekly_steps_percent())
+
+
+class ShardedStatsWriter(object):
+    '''Writes each dataset to its own file, for the dashboard to only load the charts
+    which are in view. The time series are split further, in one file per day, so
+    that only the days shown get loaded, along with a downsampled overview of their
+    whole range. A manifest lists all the files.
+
+    Each file gets a precompressed .gz sibling, for the web server to send as is
+    (gzip_static with nginx). Files whose content didn't change aren't rewritten.'''
+
+    version = 2
+    manifest_name = 'manifest.json'
+    time_series_names = ('concurrent_players', 'enough_players_percent')
+    shard_size = 24 * 3600 * 1000 # In milliseconds, like the timestamps of the time series
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def write(self, data):
+        '''Only replaces the datasets which are given in the manifest'''
+
+        manifest = self.load_manifest()
+        for name, dataset in data.iteritems():
+            if name in self.time_series_names:
+                manifest['datasets'][name] = self.write_time_series(name, dataset)
+            else:
+                file_name = name + '.json'
+                self.write_file(file_name, dataset)
+                manifest['datasets'][name] = {'path': file_name}
+
+        # Last, so that the files it lists are always there
+        self.write_file(self.manifest_name, manifest)
+
+    def load_manifest(self):
+        manifest_path = os.path.join(self.path, self.manifest_name)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == self.version:
+                return manifest
+        return {'version': self.version, 'datasets': {}}
+
+    def write_time_series(self, name, dataset):
+        '''Shards of all the series of the dataset, by day of their timestamps, and their
+        overview - see OVERVIEW_DOWNSAMPLING'''
+
+        shards = {}
+        for series_nb, series in enumerate(dataset):
+            for point in series['data']:
+                shard_nb = point[0] / self.shard_size
+                if shard_nb not in shards:
+                    shards[shard_nb] = [[] for i in xrange(len(dataset))]
+                shards[shard_nb][series_nb].append(point)
+
+        method, nb_points = DOWNSAMPLING.get(name, OVERVIEW_DOWNSAMPLING)
+        overview_name = 'overview.json'
+        self.write_file(os.path.join(name, overview_name), downsample_dataset(dataset, method, nb_points))
+
+        shards_list = []
+        shard_names = set([overview_name])
+        for shard_nb in sorted(shards):
+            shard_start = shard_nb * self.shard_size
+            shard_date = datetime.utcfromtimestamp(shard_start / 1000)
+            shard_name = shard_date.strftime('%Y-%m-%d') + '.json'
+            shard_names.add(shard_name)
+
+            shard_dataset = [{'label': series['label'], 'data': shard_data}
+                             for series, shard_data in zip(dataset, shards[shard_nb])]
+            self.write_file(os.path.join(name, shard_name), shard_dataset)
+            shards_list.append({'path': '%s/%s' % (name, shard_name),
+                                'start': shard_start,
+                                'end': shard_start + self.shard_size})
+
+        # Days which are now out of the series
+        shards_dir = os.path.join(self.path, name)
+        for file_name in os.listdir(shards_dir):
+            if file_name.endswith(('.json', '.json.gz')) and file_name.split('.')[0] + '.json' not in shard_names:
+                os.remove(os.path.join(shards_dir, file_name))
+
+        timestamps = [point[0] for series in dataset for point in series['data']]
+        return {'labels': [series['label'] for series in dataset],
+                'start': min(timestamps) if timestamps else None,
+                'end': max(timestamps) if timestamps else None,
+                'overview': '%s/%s' % (name, overview_name),
+                'shards': shards_list}
+
+    def write_file(self, file_name, content):
+        file_path = os.path.join(self.path, file_name)
+        output = json.dumps(content)
+
+        if os.path.exists(file_path) and os.path.exists(file_path + '.gz'):
+            with open(file_path) as f:
+                if f.read() == output:
+                    return
+        elif not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+
+        # The .gz first, for it to never be older than the file
+        with open(file_path + '.gz.tmp', 'wb') as f:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gzip_file:
+                gzip_file.write(output)
+        os.rename(file_path + '.gz.tmp', file_path + '.gz')
+
+        with open(file_path + '.tmp', 'w') as f:
+            f.write(output)
+        os.rename(file_path + '.tmp', file_path)
+
+
 # Main ###################################################################
 
 #cat $(for i in $(seq 594 -1 1) ; do echo cardstories.org_twisted.log.$i ; done) |
 
-start_date = datetime(2011, 10, 10, 0, 0, 0)
-action_set = ActionSet(start_date)
-concurrent_players = ConcurrentPlayers(action_set)
-cohort_set = CohortSet(action_set)
-week_set = WeeklyPlayerActivity(cohort_set)
-funnel = Funnel(action_set)
-
-# Results #
+def write_stats(data, metrics, add_meta=False, update=False):
+    '''With update, only replaces the given datasets of the previous output'''
+
+    if SHARDED_OUTPUT_PATH:
+        with metrics.stage('output'):
+            # At full resolution, the dashboard only loading the days it shows
+            ShardedStatsWriter(SHARDED_OUTPUT_PATH).write(data)
+
+    with metrics.stage('downsampling'):
+        data = downsample_data(data)
+
+    if update and os.path.exists(JSON_OUTPUT_PATH):
+        with open(JSON_OUTPUT_PATH) as f:
+            previous_data = json.load(f)
+        previous_data.pop('meta', None)
+        previous_data.update(data)
+        data = previous_data
+
+    # Replace the file at once, for the dashboard to never load a partial one
+    tmp_path = JSON_OUTPUT_PATH + '.tmp'
+    with open(tmp_path, 'w+') as f:
+        # Written as json.dumps(data) would, one dataset at a time, for the metrics to be
+        # added after them once they include the output stage
+        with metrics.stage('output'):
+            f.write('{')
+            for item_nb, (name, dataset) in enumerate(data.iteritems()):
+                if item_nb:
+                    f.write(', ')
+                f.write(json.dumps(name) + ': ' + json.dumps(dataset))
+        if add_meta:
+            f.write((', ' if data else '') + '"meta": ' + json.dumps(metrics.get_meta()))
+        f.write('}')
+    os.rename(tmp_path, JSON_OUTPUT_PATH)
+
+def follow_logs(stats, checkpoint, update, interval):
+    '''Reads the lines written to the logs since the previous update every interval
+    seconds, and calls update() after each of them, until SIGTERM or SIGINT
+
+    Rotations are noticed through the fingerprints of the log files: the end of the
+    log which has just been rotated is read from its new name. The checkpoint is saved
+    between two updates only, when the consumers state matches its offsets.'''
+
+    stop = threading.Event()
+    def request_stop(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    save_time = time.time()
+    while True:
+        # An update in progress is completed before stopping
+        stop.wait(interval)
+        if stop.is_set():
+            break
+
+        stats.process_new_actions(checkpoint)
+        update()
+
+        if time.time() - save_time >= FOLLOW_CHECKPOINT_INTERVAL:
+            checkpoint.save(stats.action_set, stats.consumers)
+            stats.save_rollup()
+            save_time = time.time()
+
+    checkpoint.save(stats.action_set, stats.consumers)
+    stats.save_rollup()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Generates the Card Stories statistics from the webservice logs')
+    arg_parser.add_argument('datasets', nargs='*', metavar='DATASET',
+                            help='datasets to compute, replacing them in the existing output - all of them '
+                                 'by default (%s)' % ', '.join(Stats.datasets_names))
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of processes parsing the log files (default: 1)')
+    arg_parser.add_argument('--settings', default='settings',
+                            help='module to read the settings from (default: settings)')
+    arg_parser.add_argument('--metrics', action='store_true',
+                            help='add the time, memory and lines counts of each stage as a "meta" block of the output')
+    arg_parser.add_argument('--metrics-log', metavar='PATH',
+                            help='append the metrics of the run to this file, one JSON object per line')
+    arg_parser.add_argument('--profile', metavar='PATH',
+                            help='write a cProfile report of the pass over the logs to this file, '
+                                 'to read with the pstats module (only the parent process with --jobs)')
+    arg_parser.add_argument('-f', '--follow', action='store_true',
+                            help='keep running, reading the new log lines and updating the output every interval')
+    arg_parser.add_argument('--interval', type=float,
+                            help='seconds between two updates with --follow (default: FOLLOW_INTERVAL)')
+    arg_parser.add_argument('--from-rollup', metavar='PERIOD', choices=TimeSliced.periods,
+                            help='print the cohorts datasets computed per %s from the ROLLUP_PATH file '
+                                 'saved by a previous run, without reading the logs' % ', '.join(TimeSliced.periods))
+    arg_parser.add_argument('--start-date', metavar='YYYY-MM-DD',
+                            help='first day of the cohorts with --from-rollup (default: 2011-10-10)')
+    arg_parser.add_argument('--partial', metavar='PATH',
+                            help='save the aggregates of the logs of this node to a file, to merge with --merge '
+                                 'on another host, rather than writing the output')
+    arg_parser.add_argument('--merge', metavar='PATH', nargs='+',
+                            help='write the output from the files saved by --partial on each node, '
+                                 'without reading any log')
+    arg_parser.add_argument('--check-parser', action='store_true',
+                            help='print the log lines which the fast parser reads differently from the '
+                                 'reference one, rather than writing the output - exits with 1 if there are any')
+    args = arg_parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+
+    load_settings(args.settings)
+    metrics = RunMetrics(enabled=args.metrics or bool(args.metrics_log))
+
+    start_date = datetime(2011, 10, 10, 0, 0, 0)
+
+    if args.check_parser:
+        nb_mismatches = 0
+        for line in ActionSet(start_date).iter_parser_mismatches():
+            sys.stdout.write(line)
+            nb_mismatches += 1
+        if nb_mismatches:
+            logger.error('%d lines parsed differently by the reference parser', nb_mismatches)
+            sys.exit(1)
+        return
+    if args.from_rollup:
+        if not ROLLUP_PATH or not os.path.exists(ROLLUP_PATH):
+            arg_parser.error('--from-rollup needs the ROLLUP_PATH file, saved by a previous run')
+        try:
+            if args.start_date:
+                start_date = datetime.strptime(args.start_date, '%Y-%m-%d')
+            data = DailyRollup.load(ROLLUP_PATH).get_cohorts_data(start_date, args.from_rollup)
+        except ValueError as e:
+            arg_parser.error(str(e))
+        sys.stdout.write(json.dumps(data) + '\n')
+        return
+    if (args.partial or args.merge) and args.follow or args.partial and args.merge:
+        arg_parser.error('--partial and --merge cannot be used together, nor with --follow')
+    try:
+        stats = Stats(start_date, args.datasets or None, metrics=metrics, partial=bool(args.partial or args.merge))
+    except ValueError as e:
+        arg_parser.error(str(e))
+    # The partials always cover all the logs of their node
+    if (CHECKPOINT_PATH or args.follow) and not args.partial:
+        checkpoint = Checkpoint(CHECKPOINT_PATH)
+    else:
+        checkpoint = None
+
+    if args.merge:
+        try:
+            stats.merge_partials(args.merge)
+        except ValueError as e:
+            arg_parser.error(str(e))
+        write_stats(stats.get_data(), metrics, add_meta=args.metrics, update=bool(args.datasets))
+        return
 
-data = {}
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.runcall(stats.process_actions, checkpoint=checkpoint, jobs=args.jobs)
+        profile.dump_stats(args.profile)
+    else:
+        stats.process_actions(checkpoint=checkpoint, jobs=args.jobs)
 
-weekly_actives = cohort_set.get_weekly_actives()
-data['weekly_actives'] = add_average_to_weekly_set(weekly_actives)
+    if args.partial:
+        stats.save_partial(args.partial)
+        return
 
-weekly_actives_percent = cohort_set.get_weekly_actives_percent()
-data['weekly_actives_percent'] = add_average_to_weekly_set(weekly_actives_percent)
+    update_output = bool(args.datasets)
+    write_stats(stats.get_data(), metrics, add_meta=args.metrics, update=update_output)
 
-data['active_players_per_week'] = week_set.get_active_players_per_week()
-data['concurrent_players'] = concurrent_players.get_concurrent_players_trimmed()
-data['enough_players_percent'] = concurrent_players.get_time_percent_with_enough_players()
+    if args.metrics_log:
+        with open(args.metrics_log, 'a') as f:
+            f.write(json.dumps(metrics.get_meta()) + '\n')
 
-weekly_steps_percent = funnel.get_weekly_steps_percent()
-data['funnel'] = add_average_to_weekly_set(weekly_steps_percent)
+    if args.follow:
+        def update():
+            stats.refresh_owa_data(FOLLOW_OWA_INTERVAL)
+            write_stats(stats.get_data(wait_owa=False), metrics, add_meta=args.metrics, update=update_output)
 
-with open(JSON_OUTPUT_PATH, 'w+') as f:
-    json.dump(data, f)
+        follow_logs(stats, checkpoint, update, args.interval or FOLLOW_INTERVAL)
 
 
+if __name__ == '__main__':
+    main()
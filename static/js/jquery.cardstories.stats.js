@@ -1,12 +1,21 @@
 $(function($) {
     $.cardstories_stats = {
-        data: null,
+        data: {},
+        
+        // List of the files of each dataset, when the stats are written with SHARDED_OUTPUT_PATH
+        manifest: null,
+        
+        // Loaded days of the time series, by path
+        shards: {},
+        
+        // Loaded overviews of the time series, by path
+        overviews: {},
             
         init: function() {
             var $this = this;
             var deferred = $.Deferred();
 
-            $.when($this.load_data()).done(function() {
+            $.when($this.load_manifest()).done(function() {
                 $this.show_stats();
                 deferred.resolve();
             })
@@ -14,6 +23,23 @@ $(function($) {
             return deferred.promise();
         },
         
+        load_manifest: function() {
+            var $this = this;
+            var deferred = $.Deferred();
+            
+            $.getJSON("data/manifest.json", function(manifest) {
+                $this.manifest = manifest;
+                deferred.resolve();
+            }).fail(function() {
+                // No sharded output, all the datasets are in a single file
+                $.when($this.load_data()).done(function() {
+                    deferred.resolve();
+                });
+            });
+            
+            return deferred.promise();
+        },
+        
         load_data: function() {
             var $this = this;
             var deferred = $.Deferred();
@@ -21,12 +47,11 @@ $(function($) {
             $.getJSON("data/cardstories_stats.json", function(data) {
                 $this.data = data;
                 
-                // Hard-code color indices to prevent them from shifting as sets are turned on/off
                 $.each($this.data, function(i, dataset) {
-                    $.each(dataset, function(j, row) {
-                        row.color = j*2;
-                        i++;
-                    });
+                    if(i == 'meta') {
+                        return; // Run metrics, not a dataset
+                    }
+                    $this.set_colors(dataset);
                 });
 
                 deferred.resolve();
@@ -35,6 +60,110 @@ $(function($) {
             return deferred.promise();
         },
         
+        // Loads a dataset from its own file, or from its shards - only the days between 'from' and 'to' when
+        // either is given, the downsampled overview of the whole time series otherwise
+        load_dataset: function(dataset_name, from, to) {
+            var $this = this;
+            var deferred = $.Deferred();
+            var entry = $this.manifest ? $this.manifest.datasets[dataset_name] : null;
+            
+            if(!entry) {
+                deferred.resolve(); // Already loaded from the single file
+            } else if(entry.path) {
+                if($this.data[dataset_name]) {
+                    deferred.resolve();
+                } else {
+                    $.getJSON("data/"+entry.path, function(dataset) {
+                        $this.set_colors(dataset);
+                        $this.data[dataset_name] = dataset;
+                        deferred.resolve();
+                    });
+                }
+            } else if(from === undefined && to === undefined && entry.overview) {
+                if($this.overviews[entry.overview]) {
+                    $this.data[dataset_name] = $this.overviews[entry.overview];
+                    deferred.resolve();
+                } else {
+                    $.getJSON("data/"+entry.overview, function(dataset) {
+                        $this.set_colors(dataset);
+                        $this.overviews[entry.overview] = dataset;
+                        $this.data[dataset_name] = dataset;
+                        deferred.resolve();
+                    });
+                }
+            } else {
+                var requests = [];
+                $.each(entry.shards, function(i, shard) {
+                    if($this.shard_in_range(shard, from, to) && !$this.shards[shard.path]) {
+                        requests.push($.getJSON("data/"+shard.path, function(shard_dataset) {
+                            $this.shards[shard.path] = shard_dataset;
+                        }));
+                    }
+                });
+                
+                $.when.apply($, requests).done(function() {
+                    $this.data[dataset_name] = $this.merge_shards(entry, from, to);
+                    deferred.resolve();
+                });
+            }
+            
+            return deferred.promise();
+        },
+        
+        shard_in_range: function(shard, from, to) {
+            return (from === undefined || shard.end > from) && (to === undefined || shard.start < to);
+        },
+        
+        merge_shards: function(entry, from, to) {
+            var $this = this;
+            var dataset = [];
+            
+            $.each(entry.labels, function(i, label) {
+                dataset.push({ label: label, data: [] });
+            });
+            $.each(entry.shards, function(i, shard) {
+                var shard_dataset = $this.shards[shard.path];
+                if(shard_dataset && $this.shard_in_range(shard, from, to)) {
+                    $.each(shard_dataset, function(j, row) {
+                        dataset[j].data = dataset[j].data.concat(row.data);
+                    });
+                }
+            });
+            
+            $this.set_colors(dataset);
+            return dataset;
+        },
+        
+        set_colors: function(dataset) {
+            // Hard-code color indices to prevent them from shifting as sets are turned on/off
+            $.each(dataset, function(j, row) {
+                row.color = j*2;
+            });
+        },
+        
+        // Timestamp of the start of the initial view of a time series, or undefined to show it all
+        get_initial_from: function(dataset_name, initial_days) {
+            var entry = this.manifest ? this.manifest.datasets[dataset_name] : null;
+            
+            if(!initial_days || !entry || !entry.shards || entry.end === null) {
+                return undefined;
+            }
+            return entry.end - initial_days*24*3600*1000;
+        },
+        
+        when_in_view: function(element, callback) {
+            var event_names = 'scroll.'+element.attr('id')+' resize.'+element.attr('id');
+            var check = function() {
+                if($(window).scrollTop() + $(window).height() >= element.offset().top) {
+                    $(window).unbind(event_names);
+                    callback();
+                }
+            };
+            
+            $(window).bind(event_names, check);
+            check();
+        },
+        
         show_stats: function() {
             var $this = this;
             
@@ -42,6 +171,7 @@ $(function($) {
             
             $this.show_stats_for('concurrent_players', {
                 show: false,
+                initial_days: 7,
                 unit: '',
                 default_selector: function(label) {
                     return true;
@@ -138,14 +268,22 @@ $(function($) {
         
         show_stats_for: function(dataset_name, table_options, plot_options) {
             var $this = this;
-            var table = $('#table_'+dataset_name);
+            var from = $this.get_initial_from(dataset_name, table_options.initial_days);
  
-            if(table_options.show) {
-                $this.draw_table(dataset_name, table_options, plot_options);                
-                $this.plot_according_to_choices(dataset_name, plot_options);
-            } else {
-                $this.draw_plot(dataset_name, plot_options, $this.data[dataset_name]);
-            }
+            // Only loaded once the chart is scrolled to
+            $this.when_in_view($('#plot_'+dataset_name), function() {
+                $.when($this.load_dataset(dataset_name, from)).done(function() {
+                    if(table_options.show) {
+                        $this.draw_table(dataset_name, table_options, plot_options);
+                        $this.plot_according_to_choices(dataset_name, plot_options);
+                    } else if(from !== undefined) {
+                        $this.draw_plot(dataset_name, $.extend(true, {}, plot_options, { xaxis: { min: from } }),
+                                        $this.data[dataset_name]);
+                    } else {
+                        $this.draw_plot(dataset_name, plot_options, $this.data[dataset_name]);
+                    }
+                });
+            });
         },
 
         draw_table: function(dataset_name, table_options, plot_options) {
@@ -215,7 +353,8 @@ $(function($) {
         
         draw_plot: function(dataset_name, plot_options, data) {
             var $this = this;
-            var orig_xaxis = plot_options.xaxis;
+            var sharded = $this.manifest && $this.manifest.datasets[dataset_name] &&
+                          $this.manifest.datasets[dataset_name].shards;
             
             if (data.length > 0) {
                 var plot = $.plot($("#plot_"+dataset_name), data, plot_options);
@@ -228,17 +367,30 @@ $(function($) {
             });
             
             // Selection zoom
+            $("#plot_"+dataset_name).unbind("plotselected");
             $("#plot_"+dataset_name).bind("plotselected", function (event, ranges) {
-                // do the zooming
-                plot = $.plot($("#plot_"+dataset_name), data,
-                              $.extend(true, {}, plot_options, {
-                                  xaxis: { min: ranges.xaxis.from, max: ranges.xaxis.to }
-                              }));
+                // do the zooming, on the days of the selection at full resolution
+                $.when(sharded ? $this.load_dataset(dataset_name, ranges.xaxis.from, ranges.xaxis.to) : null).done(function() {
+                    if(sharded) {
+                        data = $this.data[dataset_name];
+                    }
+                    plot = $.plot($("#plot_"+dataset_name), data,
+                                  $.extend(true, {}, plot_options, {
+                                      xaxis: { min: ranges.xaxis.from, max: ranges.xaxis.to }
+                                  }));
+                });
             });
+            $("#reset_"+dataset_name).unbind("click");
             $("#reset_"+dataset_name).click(function () {
-                $.plot($("#plot_"+dataset_name), data, 
+                // Shows all the days, from the overview of the time series
+                $.when(sharded ? $this.load_dataset(dataset_name) : null).done(function() {
+                    if(sharded) {
+                        data = $this.data[dataset_name];
+                    }
+                    plot = $.plot($("#plot_"+dataset_name), data, 
                                   $.extend(true, {}, plot_options, {
-                                          xaxis: orig_xaxis }));
+                                          xaxis: { min: null, max: null } }));
+                });
             });
         },
         